@@ -9,6 +9,7 @@ app.use(cors({
   origin: '*', // For development only, tighten this for production
   methods: ['GET', 'POST', 'PUT', 'DELETE', 'OPTIONS'],
   allowedHeaders: ['Content-Type', 'Authorization'],
+  exposedHeaders: ['X-Processing-Metrics'],
   credentials: true
 }));
 
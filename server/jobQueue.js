@@ -0,0 +1,36 @@
+const fs = require('fs');
+const path = require('path');
+const crypto = require('crypto');
+
+// Queue directory watched by python/worker.py (its default --queue_dir)
+const QUEUE_DIR = path.join(__dirname, '../uploads/.cache/jobs');
+
+const writeJsonAtomic = (filePath, data) => {
+    const tmpPath = `${filePath}.${process.pid}.tmp`;
+    fs.writeFileSync(tmpPath, JSON.stringify(data));
+    fs.renameSync(tmpPath, filePath);
+};
+
+// Queue a job for the Python worker and return its id
+const submitJob = (type, location, options = []) => {
+    // Timestamp prefix keeps the worker's sorted scan first-in, first-out
+    const jobId = `${Date.now()}-${crypto.randomBytes(4).toString('hex')}`;
+    const jobDir = path.join(QUEUE_DIR, jobId);
+    fs.mkdirSync(jobDir, { recursive: true });
+
+    const submittedAt = new Date().toISOString();
+    writeJsonAtomic(path.join(jobDir, 'status.json'), { status: 'queued', submitted_at: submittedAt });
+    // job.json is written last: its appearance is what the worker picks up
+    writeJsonAtomic(path.join(jobDir, 'job.json'), { id: jobId, type, location, options, submitted_at: submittedAt });
+    return jobId;
+};
+
+// Current status of a job, or null if the id is unknown
+const getJobStatus = jobId => {
+    if (!/^[\w-]+$/.test(jobId)) return null;
+    const statusPath = path.join(QUEUE_DIR, jobId, 'status.json');
+    if (!fs.existsSync(statusPath)) return null;
+    return { jobId, ...JSON.parse(fs.readFileSync(statusPath, 'utf8')) };
+};
+
+module.exports = { QUEUE_DIR, submitJob, getJobStatus };
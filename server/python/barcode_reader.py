@@ -0,0 +1,101 @@
+import logging
+import re
+
+from PIL import Image, ImageOps
+from image_preprocessing import draft_box
+
+logger = logging.getLogger(__name__)
+
+# Optional decoders: zxing-cpp reads 1D codes and DataMatrix in one pass;
+# pyzbar (1D/QR) plus pylibdmtx (DataMatrix) is the fallback
+try:
+    import zxingcpp
+except ImportError:
+    zxingcpp = None
+
+try:
+    from pyzbar import pyzbar
+except ImportError:
+    pyzbar = None
+
+try:
+    from pylibdmtx import pylibdmtx
+except ImportError:
+    pylibdmtx = None
+
+# Photos are decoded downscaled to this size; label barcodes stay readable
+DECODE_EDGE = 2000
+
+# ANSI MH10.8.2 data identifiers printed on equipment labels, e.g. "(S)T0M1049689".
+# Only fields of an ISO 15434 envelope are known to start with a data identifier,
+# so a bare "S" or "1P" is accepted there; a standalone code needs the bracketed
+# form, otherwise "SHELF-A1" would read as serial "HELF-A1". Values must contain
+# a digit so words that happen to start with S are skipped.
+SERIAL_PATTERN = re.compile(r'^\(S\)\s*(?=[^\d]*\d)([A-Z0-9][A-Z0-9./-]{4,})$')
+PART_NUMBER_PATTERN = re.compile(r'^\(1P\)\s*(?=[^\d]*\d)([A-Z0-9][A-Z0-9 ./-]{2,})$')
+ENVELOPE_SERIAL_PATTERN = re.compile(r'^S(?=[^\d]*\d)([A-Z0-9][A-Z0-9./-]{4,})$')
+ENVELOPE_PART_NUMBER_PATTERN = re.compile(r'^1P(?=[^\d]*\d)([A-Z0-9][A-Z0-9 ./-]{2,})$')
+ASSET_TAG_PATTERN = re.compile(r'^ATT\d{6,}$')
+
+# ISO 15434 envelope ("[)>" RS "06" GS field GS field ... RS EOT); some
+# decoders render the separators as their Unicode control pictures
+ENVELOPE_HEADER = '[)>'
+SEPARATORS = re.compile('[\x1d\x1e\x04␝␞␄]')
+
+
+def available():
+    """Whether a barcode decoder is installed"""
+    return zxingcpp is not None or pyzbar is not None or pylibdmtx is not None
+
+
+def decode_barcodes(image):
+    """Text of every barcode found in a PIL image"""
+    if zxingcpp is not None:
+        return [result.text for result in zxingcpp.read_barcodes(image)]
+    values = []
+    if pyzbar is not None:
+        values += [symbol.data.decode('utf-8', 'replace') for symbol in pyzbar.decode(image)]
+    if pylibdmtx is not None:
+        values += [symbol.data.decode('utf-8', 'replace') for symbol in pylibdmtx.decode(image)]
+    return values
+
+
+def parse_label_fields(values):
+    """Map decoded barcode texts to serial_number, part_number and asset_tag.
+
+    Only fields identified by their data identifier or ATT prefix are kept;
+    bare data identifiers count only inside an ISO 15434 envelope. Returns {} when a field decodes to more than one distinct value, since a
+    label with two serials (or a photo of two labels) needs the model to tell
+    which belongs to the item.
+    """
+    found = {'serial_number': set(), 'part_number': set(), 'asset_tag': set()}
+    for value in values:
+        enveloped = value.strip().startswith(ENVELOPE_HEADER)
+        serial_pattern = ENVELOPE_SERIAL_PATTERN if enveloped else SERIAL_PATTERN
+        part_number_pattern = ENVELOPE_PART_NUMBER_PATTERN if enveloped else PART_NUMBER_PATTERN
+        for field in SEPARATORS.split(value):
+            field = field.strip().upper()
+            if not field or field in (ENVELOPE_HEADER, '06'):
+                continue
+            if ASSET_TAG_PATTERN.match(field):
+                found['asset_tag'].add(field)
+            elif match := part_number_pattern.match(field):
+                found['part_number'].add(match.group(1).replace(' ', ''))
+            elif match := serial_pattern.match(field):
+                found['serial_number'].add(match.group(1))
+
+    if any(len(codes) > 1 for codes in found.values()):
+        return {}
+    return {key: codes.pop() for key, codes in found.items() if codes}
+
+
+def read_label_fields(image_path, max_edge=DECODE_EDGE):
+    """Decode the barcodes in a photo and return parse_label_fields() of them"""
+    with Image.open(image_path) as image:
+        image.draft('L', draft_box(image.size, max_edge))
+        image = ImageOps.exif_transpose(image).convert('L')
+        image.thumbnail((max_edge, max_edge))
+        values = decode_barcodes(image)
+    if values:
+        logger.debug(f"Barcodes in {image_path}: {values}")
+    return parse_label_fields(values)
@@ -0,0 +1,304 @@
+"""Offline end-to-end benchmark for the equipment and JHA processors.
+
+Starts mock_openai_server.py on a local port, generates synthetic photo
+folders and Network_Extract catalogs, and runs process_equipment.py and
+process_jha.py through their main() against it, each in a fresh
+interpreter. Reports images/sec, catalog load and matching time per catalog
+size, API calls and retries, and peak memory; --report also saves them as
+JSON so runs can be compared.
+
+    python benchmark.py --images 40 --catalog_sizes 1000 10000 50000 --latency_ms 300 --rate_limit 0.05
+"""
+import argparse
+import json
+import os
+import random
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+from PIL import Image
+
+from mock_openai_server import MockOpenAI, start_server
+
+try:
+    import resource
+except ImportError:  # Not available on Windows; peak memory is not reported there
+    resource = None
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+JHA_SAMPLE_DIR = os.path.join(SCRIPT_DIR, '..', '..', 'uploads', 'jha', '12345')
+JHA_OUTPUT_ROOT = os.path.join(SCRIPT_DIR, '..', '..', 'output', 'jha')
+
+BRANDS = ['Ericsson', 'Nokia', 'Commscope', 'Kathrein', 'Raycap', 'Samsung', 'Andrew', 'Eltek', 'Huawei', 'Amphenol']
+KINDS = ['antenna', 'radio', 'rectifier', 'diplexer', 'combiner', 'surge protector', 'battery cabinet',
+         'baseband unit', 'jumper cable', 'mounting bracket', 'power supply', 'filter', 'amplifier']
+SPECS = ['8 port 65 degree', '4 port 33 degree', '700 MHz', '1900 MHz', 'AWS', '48V DC', 'outdoor',
+         'dual band', 'tri band', 'low PIM', 'high gain', '2x2 MIMO', '4x4 MIMO', '10 ft', '20 ft']
+
+
+def _measure(script, argv):
+    """Child mode: run a processor's main() and print its peak memory as the last stdout line"""
+    sys.argv = [script] + argv
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    try:
+        runpy.run_path(script, run_name='__main__')
+    finally:
+        peak_mb = None
+        if resource is not None:
+            # ru_maxrss is KiB on Linux; children covers process pools
+            peak_kib = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                           resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+            peak_mb = round(peak_kib / 1024, 1)
+        sys.stdout.flush()
+        print(json.dumps({'peak_rss_mb': peak_mb}))
+
+
+def make_catalog(path, rows, seed=0):
+    """Write a synthetic Network_Extract catalog with `rows` items and return it"""
+    rng = random.Random(seed)
+    letters = 'ABCDEFGHJKLMNPRSTUVWXYZ'
+    df = pd.DataFrame({
+        'Item Number': [100000 + i for i in range(rows)],
+        'Manufacturer Part Number': [
+            f"{''.join(rng.choices(letters, k=3))} {i:06d}/{rng.randint(1, 9)}" for i in range(rows)
+        ],
+        'Item Description': [
+            f"{rng.choice(BRANDS)} {rng.choice(KINDS)} {rng.choice(SPECS)} model {rng.randint(1, 999)}"
+            for _ in range(rows)
+        ]
+    })
+    df.to_excel(path, sheet_name='Network_Extract', index=False)
+    return df
+
+
+def make_responses(catalog, count, seed=0):
+    """Canned vision answers that exercise every matching stage.
+
+    Roughly 40% exact part numbers, 25% descriptions containing a catalog
+    description, 15% keyword overlap only, 10% mistyped part numbers and 10%
+    items found nowhere in the catalog.
+    """
+    rng = random.Random(seed)
+    responses = []
+    for n in range(count):
+        items = []
+        for _ in range(rng.randint(1, 3)):
+            row = catalog.iloc[rng.randrange(len(catalog))]
+            part_number, description = row['Manufacturer Part Number'], row['Item Description']
+            kind = rng.random()
+            if kind < 0.4:
+                item = {'part_number': f"(1P){part_number}" if rng.random() < 0.5 else part_number,
+                        'description': 'equipment'}
+            elif kind < 0.65:
+                item = {'part_number': 'unreadable', 'description': f"{description} with mounting kit"}
+            elif kind < 0.8:
+                words = description.split()
+                rng.shuffle(words)
+                item = {'part_number': 'unreadable', 'description': ' '.join(words[:3])}
+            elif kind < 0.9:
+                position = rng.randrange(len(part_number))
+                item = {'part_number': part_number[:position] + 'Q' + part_number[position + 1:],
+                        'description': 'qz xv'}
+            else:
+                item = {'part_number': f"ZZ{rng.randint(0, 10 ** 6)}", 'description': 'qz xv wk'}
+            item.update(serial_number=f"SN{n:04d}{rng.randint(0, 9999):04d}", asset_tag=f"ATT{rng.randint(0, 10 ** 7)}")
+            items.append(item)
+        responses.append(items if len(items) > 1 else items[0])
+    return responses
+
+
+def make_photos(photo_dir, count, size=(4000, 3000), seed=0):
+    """Write `count` distinct photo-sized JPEGs with smooth, photo-like content"""
+    os.makedirs(photo_dir, exist_ok=True)
+    rng = random.Random(seed)
+    small = (max(size[0] // 16, 1), max(size[1] // 16, 1))
+    for i in range(count):
+        noise = Image.frombytes('RGB', small, rng.randbytes(small[0] * small[1] * 3))
+        noise.resize(size, Image.BICUBIC).save(os.path.join(photo_dir, f"photo_{i:04d}.jpg"), quality=90)
+
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def make_jha_location(uploads_root, location, count, source_dir=JHA_SAMPLE_DIR):
+    """Copy the sample JHA PDF `count` times (one per day) and its Excel template"""
+    pdf_dir = os.path.join(uploads_root, 'jha', location, 'pdfs')
+    os.makedirs(pdf_dir, exist_ok=True)
+    sample_pdfs = sorted(f for f in os.listdir(os.path.join(source_dir, 'pdfs')) if f.endswith('.pdf'))
+    for day in range(count):
+        source = os.path.join(source_dir, 'pdfs', sample_pdfs[day % len(sample_pdfs)])
+        link_or_copy(source, os.path.join(pdf_dir, f"2025-01-{day % 28 + 1:02d} {day // 28:02d}-00-00.pdf"))
+    shutil.copytree(os.path.join(source_dir, 'excel'), os.path.join(uploads_root, 'jha', location, 'excel'),
+                    ignore=shutil.ignore_patterns('~$*'))
+
+
+def run_processor(script, argv, env, cwd):
+    """Run a processor's main() in a fresh interpreter; returns (wall seconds, peak MB)"""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), '_measure', script] + argv,
+                            env=env, cwd=cwd, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    lines = result.stdout.strip().splitlines()
+    try:
+        peak_mb = json.loads(lines[-1])['peak_rss_mb']
+    except (IndexError, ValueError, KeyError):
+        peak_mb = None
+    if result.returncode != 0:
+        raise RuntimeError(f"{os.path.basename(script)} failed:\n{result.stderr[-2000:]}")
+    return wall, peak_mb
+
+
+def _load_metrics(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _summarize(name, units, count, wall, peak_mb, metrics):
+    stages = metrics.get('stages', {})
+    api_calls = metrics.get('api_calls', {}).values()
+    local_matching = sum(s['seconds'] for stage, s in stages.items()
+                         if stage.startswith('match.') and stage != 'match.ai_batch')
+    return {
+        'scenario': name,
+        units: count,
+        'wall_seconds': round(wall, 2),
+        f"{units}_per_sec": round(count / wall, 2) if wall else None,
+        'catalog_load_seconds': stages.get('catalog_load', {}).get('seconds'),
+        'local_matching_seconds': round(local_matching, 3),
+        'ai_matching_seconds': stages.get('match.ai_batch', {}).get('seconds'),
+        'api_calls': sum(c['calls'] for c in api_calls),
+        'api_retries': sum(c['retries'] for c in api_calls),
+        'peak_rss_mb': peak_mb,
+        'metrics': metrics
+    }
+
+
+def benchmark_equipment(work_dir, env, args, responses_for):
+    """One cold run per catalog size over the same photos"""
+    results = []
+    photos = os.path.join(work_dir, 'photos')
+    make_photos(photos, args.images, tuple(args.photo_size))
+    for size in args.catalog_sizes:
+        location = f"bench-{size}"
+        uploads_root = os.path.join(work_dir, 'uploads')
+        photo_dir = os.path.join(uploads_root, 'photos', location)
+        os.makedirs(photo_dir, exist_ok=True)
+        for photo in os.listdir(photos):
+            link_or_copy(os.path.join(photos, photo), os.path.join(photo_dir, photo))
+        manufacturer_dir = os.path.join(uploads_root, 'manufacturer', location)
+        os.makedirs(manufacturer_dir, exist_ok=True)
+        print(f"Generating {size}-row catalog...")
+        catalog = make_catalog(os.path.join(manufacturer_dir, 'catalog.xlsx'), size)
+        responses_for(make_responses(catalog, args.images))
+
+        output = os.path.join(work_dir, 'output', f"equipment_inventory_{size}.csv")
+        argv = ['--location', location, '--output', output, '--uploads_root', uploads_root,
+                '--cache_dir', os.path.join(work_dir, f"cache-{size}"), '--no_cache',
+                '--max_workers', str(args.max_workers), '--requests_per_minute', str(args.requests_per_minute)]
+        print(f"Running equipment scenario with {size}-row catalog...")
+        wall, peak_mb = run_processor(os.path.join(SCRIPT_DIR, 'process_equipment.py'), argv, env, work_dir)
+        if not os.path.exists(output):
+            raise RuntimeError(f"No inventory written for {location}; see {work_dir}/equipment_processor.log")
+        metrics = _load_metrics(os.path.splitext(output)[0] + '.metrics.json')
+        result = _summarize(f"equipment catalog={size}", 'images', args.images, wall, peak_mb, metrics)
+        result['catalog_rows'] = size
+        results.append(result)
+    return results
+
+
+def benchmark_jha(work_dir, env, args):
+    """The same PDFs parsed locally, then forced through the model"""
+    results = []
+    uploads_root = os.path.join(work_dir, 'uploads')
+    location = f"bench-jha-{os.getpid()}"
+    make_jha_location(uploads_root, location, args.pdfs)
+    output_dir = os.path.join(JHA_OUTPUT_ROOT, location)
+    try:
+        for name, extra in (('jha local parse', []), ('jha model parse', ['--min_confidence', '1.1'])):
+            argv = ['--uploads_root', uploads_root, '--location', location, '--no_cache',
+                    '--max_workers', str(args.max_workers)] + extra
+            print(f"Running {name} scenario...")
+            wall, peak_mb = run_processor(os.path.join(SCRIPT_DIR, 'process_jha.py'), argv, env, work_dir)
+            metrics = _load_metrics(os.path.join(output_dir, 'jha_processed.metrics.json'))
+            results.append(_summarize(name, 'pdfs', args.pdfs, wall, peak_mb, metrics))
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+
+def print_report(results):
+    print()
+    print(f"{'scenario':<28}{'wall s':>9}{'items/s':>9}{'catalog s':>11}{'match s':>9}{'AI match s':>12}"
+          f"{'calls':>7}{'retries':>9}{'peak MB':>9}")
+    for r in results:
+        rate = r.get('images_per_sec', r.get('pdfs_per_sec'))
+        print(f"{r['scenario']:<28}{r['wall_seconds']:>9}{rate:>9}{str(r['catalog_load_seconds'] or '-'):>11}"
+              f"{r['local_matching_seconds']:>9}{str(r['ai_matching_seconds'] or '-'):>12}"
+              f"{r['api_calls']:>7}{r['api_retries']:>9}{str(r['peak_rss_mb']):>9}")
+
+
+def main():
+    if len(sys.argv) > 2 and sys.argv[1] == '_measure':
+        return _measure(sys.argv[2], sys.argv[3:])
+
+    parser = argparse.ArgumentParser(description="Benchmark the processors against a local mock OpenAI API.")
+    parser.add_argument('--images', type=int, default=20, help='Synthetic photos per equipment scenario')
+    parser.add_argument('--photo_size', type=int, nargs=2, default=[4000, 3000], metavar=('WIDTH', 'HEIGHT'))
+    parser.add_argument('--catalog_sizes', type=int, nargs='+', default=[1000, 10000],
+                        help='Catalog rows; one equipment scenario per size')
+    parser.add_argument('--pdfs', type=int, default=10, help='JHA PDFs per JHA scenario')
+    parser.add_argument('--latency_ms', type=float, default=300, help='Mock API mean latency')
+    parser.add_argument('--rate_limit', type=float, default=0.0, help='Fraction of mock API requests answered with 429')
+    parser.add_argument('--max_workers', type=int, default=4)
+    parser.add_argument('--requests_per_minute', type=float, default=6000)
+    parser.add_argument('--skip_equipment', action='store_true')
+    parser.add_argument('--skip_jha', action='store_true')
+    parser.add_argument('--work_dir', default=None, help='Keep generated data here instead of a temporary directory')
+    parser.add_argument('--report', default=None, help='Also write the results as JSON to this path')
+    args = parser.parse_args()
+
+    mock = MockOpenAI(None, latency_ms=args.latency_ms, rate_limit=args.rate_limit, retry_after=0.2)
+    server = start_server(mock)
+    env = dict(os.environ,
+               OPENAI_BASE_URL=f"http://127.0.0.1:{server.server_port}/v1",
+               OPENAI_API_KEY='benchmark',
+               OPENAI_REQUESTS_PER_MINUTE=str(args.requests_per_minute))
+
+    def responses_for(responses):
+        mock.responses = responses
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='equipment-benchmark-')
+    os.makedirs(work_dir, exist_ok=True)
+    results = []
+    try:
+        if not args.skip_equipment:
+            results += benchmark_equipment(work_dir, env, args, responses_for)
+        if not args.skip_jha:
+            results += benchmark_jha(work_dir, env, args)
+    finally:
+        server.shutdown()
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_report(results)
+    print(f"\nMock API: {mock.requests} requests, {mock.rejected} rejected with 429")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"Report written to {args.report}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,454 @@
+import heapq
+import json
+import logging
+import math
+import os
+import re
+import tempfile
+from collections import Counter, defaultdict
+from difflib import SequenceMatcher
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+NGRAM_SIZE = 3
+MIN_KEYWORD_LENGTH = 4
+
+# Barcode data identifiers printed in front of part numbers, e.g. "(1P)KRE 101 2283/1"
+PART_NUMBER_PREFIX = r'^\s*\(\s*(?:1P|P|S)\s*\)'
+MISSING_PART_NUMBERS = {'', 'NAN', 'NONE', 'NULL', 'NA'}
+
+# The only manufacturer columns matching uses
+CATALOG_COLUMNS = ['Item Number', 'Manufacturer Part Number', 'Item Description']
+
+
+def char_ngrams(text, n=NGRAM_SIZE):
+    """Set of overlapping character n-grams in text"""
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _anchor_index(strings):
+    """Index each string under its rarest n-gram.
+
+    Any text containing a string must also contain that string's rarest
+    n-gram, so looking up the text's own n-grams finds every candidate while
+    touching only the few strings anchored on rare n-grams.
+    """
+    frequency = Counter(gram for s in strings for gram in char_ngrams(s))
+    anchors = defaultdict(list)
+    for s in strings:
+        grams = char_ngrams(s)
+        if grams:
+            anchors[min(grams, key=lambda g: (frequency[g], g))].append(s)
+    return anchors
+
+
+class DescriptionIndex:
+    """Inverted index over catalog `Item Description` values.
+
+    Answers the two local description-matching stages without scanning the
+    catalog: catalog descriptions contained in an extracted description, and
+    catalog descriptions sharing keywords with it. Both return catalog row
+    positions ranked best first.
+    """
+
+    def __init__(self, descriptions):
+        # Normalized description -> catalog row positions, in catalog order
+        self._positions = defaultdict(list)
+        for position, description in enumerate(descriptions):
+            if pd.notna(description):
+                normalized = str(description).lower()
+                if normalized:
+                    self._positions[normalized].append(position)
+
+        unique = list(self._positions)
+        self._descriptions = unique
+        self._short_descriptions = [d for d in unique if len(d) < NGRAM_SIZE]
+        self._description_anchors = _anchor_index([d for d in unique if len(d) >= NGRAM_SIZE])
+
+        # Keyword -> descriptions using it, weighted by inverse document frequency
+        self._keyword_descriptions = defaultdict(list)
+        for description in unique:
+            for word in set(description.split()):
+                if len(word) >= MIN_KEYWORD_LENGTH:
+                    self._keyword_descriptions[word].append(description)
+        self._keyword_anchors = _anchor_index(list(self._keyword_descriptions))
+        total = max(len(unique), 1)
+        self._keyword_weights = {
+            word: math.log(1 + total / len(descs)) for word, descs in self._keyword_descriptions.items()
+        }
+
+        # N-gram postings for similarity shortlists
+        self._ngram_counts = []
+        self._ngram_postings = defaultdict(list)
+        for description_id, description in enumerate(unique):
+            grams = char_ngrams(description)
+            self._ngram_counts.append(len(grams))
+            for gram in grams:
+                self._ngram_postings[gram].append(description_id)
+
+        logger.info(f"Built description index over {len(unique)} unique descriptions "
+                    f"and {len(self._keyword_descriptions)} keywords")
+
+    def to_state(self):
+        """Index contents as plain JSON-serializable values"""
+        return dict(vars(self))
+
+    @classmethod
+    def from_state(cls, state):
+        index = cls.__new__(cls)
+        index.__dict__.update(state)
+        return index
+
+    def _contained(self, anchors, text):
+        """Indexed strings that occur as substrings of text"""
+        found = []
+        for gram in char_ngrams(text):
+            for candidate in anchors.get(gram, ()):
+                if candidate in text:
+                    found.append(candidate)
+        return found
+
+    def substring_matches(self, text):
+        """Catalog rows whose description appears verbatim in text.
+
+        Returns a list of (position, score) with longer, more specific
+        descriptions first; score is the fraction of text they cover.
+        """
+        if pd.isna(text):
+            return []
+        text = str(text).lower()
+        if not text:
+            return []
+        found = self._contained(self._description_anchors, text)
+        found += [d for d in self._short_descriptions if d in text]
+        ranked = sorted(found, key=lambda d: (-len(d), self._positions[d][0]))
+        return [(self._positions[d][0], len(d) / len(text)) for d in ranked]
+
+    def keyword_matches(self, text):
+        """Catalog rows sharing at least one keyword (4+ characters) with text.
+
+        Keywords are matched as substrings of text, like the original scan.
+        Returns a list of (position, score) ranked by the summed IDF weight of
+        the shared keywords, so rows sharing rare words come first.
+        """
+        if pd.isna(text):
+            return []
+        text = str(text).lower()
+        scores = Counter()
+        for word in set(self._contained(self._keyword_anchors, text)):
+            for description in self._keyword_descriptions[word]:
+                scores[description] += self._keyword_weights[word]
+        ranked = sorted(scores, key=lambda d: (-scores[d], self._positions[d][0]))
+        return [(self._positions[d][0], scores[d]) for d in ranked]
+
+    def similar_descriptions(self, text, k=10, max_share=0.2):
+        """Top-k catalog rows by n-gram overlap with text, as (position, cosine score).
+
+        Used to shortlist candidates when no description shares a keyword
+        with text. On large catalogs, n-grams occurring in more than
+        max_share of descriptions are skipped as uninformative.
+        """
+        if pd.isna(text):
+            return []
+        grams = char_ngrams(str(text).lower())
+        if not grams:
+            return []
+        total = len(self._descriptions)
+        limit = total if total < 1000 else int(total * max_share)
+        shared = Counter()
+        for gram in grams:
+            posting = self._ngram_postings.get(gram)
+            if posting and len(posting) <= limit:
+                shared.update(posting)
+        top = heapq.nlargest(
+            k, shared.items(),
+            key=lambda item: item[1] / math.sqrt(len(grams) * self._ngram_counts[item[0]])
+        )
+        return [
+            (self._positions[self._descriptions[d]][0], count / math.sqrt(len(grams) * self._ngram_counts[d]))
+            for d, count in top
+        ]
+
+
+def normalize_part_number(value):
+    """Uppercase a part number and strip identifier prefixes, spaces and punctuation"""
+    if pd.isna(value):
+        return ''
+    normalized = re.sub(PART_NUMBER_PREFIX, '', str(value).upper())
+    normalized = re.sub(r'[^A-Z0-9]', '', normalized)
+    return '' if normalized in MISSING_PART_NUMBERS else normalized
+
+
+def normalize_part_numbers(values):
+    """Vectorized normalize_part_number() over a Series"""
+    normalized = (
+        values.astype(str).str.upper()
+        .str.replace(PART_NUMBER_PREFIX, '', regex=True)
+        .str.replace(r'[^A-Z0-9]', '', regex=True)
+    )
+    return normalized.where(values.notna() & ~normalized.isin(MISSING_PART_NUMBERS), '')
+
+
+def _padded_ngrams(key):
+    # Boundary markers give short part numbers n-grams and weight their first/last characters
+    return char_ngrams(f"^{key}$")
+
+
+class PartNumberMatcher:
+    """Exact and fuzzy lookup of catalog rows by `Manufacturer Part Number`.
+
+    Exact matches are a single hash join on normalized part numbers. Fuzzy
+    matches shortlist catalog part numbers sharing the most character n-grams
+    with the query and score only those with difflib's ratio.
+    """
+
+    def __init__(self, part_numbers, shortlist_size=25):
+        self.shortlist_size = shortlist_size
+        normalized = normalize_part_numbers(pd.Series(part_numbers).reset_index(drop=True))
+        normalized = normalized[normalized != '']
+        # Normalized part number -> first catalog row position using it
+        first = normalized.drop_duplicates()
+        self._first_position = pd.Series(first.index.values, index=first.values)
+
+        self._keys = list(self._first_position.index)
+        self._postings = defaultdict(list)
+        for key_id, key in enumerate(self._keys):
+            for gram in _padded_ngrams(key):
+                self._postings[gram].append(key_id)
+        logger.info(f"Built part number index over {len(self._keys)} unique part numbers")
+
+    def to_state(self):
+        """Index contents as plain JSON-serializable values"""
+        return {
+            'shortlist_size': self.shortlist_size,
+            'first_positions': [int(position) for position in self._first_position.values],
+            'keys': self._keys,
+            'postings': self._postings
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        matcher = cls.__new__(cls)
+        matcher.shortlist_size = state['shortlist_size']
+        matcher._keys = state['keys']
+        matcher._first_position = pd.Series(state['first_positions'], index=state['keys'], dtype=np.int64)
+        matcher._postings = state['postings']
+        return matcher
+
+    def exact_positions(self, part_numbers):
+        """Catalog row position for each exactly matching part number (NaN where none), aligned to the input"""
+        normalized = normalize_part_numbers(pd.Series(part_numbers))
+        return normalized.map(self._first_position).where(normalized != '', np.nan)
+
+    def fuzzy_match(self, part_number, cutoff=0.7):
+        """Best (position, score) for a part number by similarity, or None below cutoff"""
+        query = normalize_part_number(part_number)
+        if not query:
+            return None
+        shared = Counter()
+        for gram in _padded_ngrams(query):
+            shared.update(self._postings.get(gram, ()))
+
+        best = None
+        for key_id, _ in shared.most_common(self.shortlist_size):
+            key = self._keys[key_id]
+            score = SequenceMatcher(None, query, key).ratio()
+            if score >= cutoff and (best is None or score > best[1]):
+                best = (int(self._first_position[key]), score)
+        return best
+
+
+def _semantic_grams(description, part_number=None):
+    """Character n-gram counts of a description plus its normalized part number"""
+    text = ' '.join(str(description).lower().split()) if pd.notna(description) else ''
+    part_number = normalize_part_number(part_number).lower() if part_number is not None else ''
+    grams = Counter(f" {text} "[i:i + NGRAM_SIZE] for i in range(len(text) + 3 - NGRAM_SIZE)) if text else Counter()
+    if part_number:
+        grams.update(_padded_ngrams(part_number))
+    return grams
+
+
+class SemanticMatcher:
+    """TF-IDF weighted character n-gram vectors over catalog rows.
+
+    Each row's vector covers its `Item Description` and normalized
+    `Manufacturer Part Number`. Vectors are stored column-wise, one posting
+    array per n-gram, so scoring a query only touches the postings of its
+    own n-grams and sums them with np.bincount into cosine similarities for
+    every row at once.
+    """
+
+    def __init__(self, descriptions, part_numbers):
+        documents = [_semantic_grams(d, p) for d, p in zip(descriptions, part_numbers)]
+        self._rows = len(documents)
+
+        frequency = Counter(gram for grams in documents for gram in grams)
+        self._vocabulary = {gram: gram_id for gram_id, gram in enumerate(frequency)}
+        self._idf = np.log((1 + self._rows) / (1 + np.array(list(frequency.values()), dtype=np.float64))) + 1
+
+        rows, columns, weights = [], [], []
+        for position, grams in enumerate(documents):
+            ids = np.fromiter((self._vocabulary[gram] for gram in grams), dtype=np.int64, count=len(grams))
+            values = np.fromiter(grams.values(), dtype=np.float64, count=len(grams)) * self._idf[ids]
+            norm = np.sqrt(values @ values)
+            if norm:
+                rows.append(np.full(len(ids), position, dtype=np.int32))
+                columns.append(ids)
+                weights.append(values / norm)
+
+        columns = np.concatenate(columns) if columns else np.empty(0, dtype=np.int64)
+        order = np.argsort(columns, kind='stable')
+        self._indices = np.concatenate(rows)[order] if rows else np.empty(0, dtype=np.int32)
+        self._data = (np.concatenate(weights)[order] if weights else np.empty(0)).astype(np.float32)
+        self._indptr = np.concatenate(([0], np.cumsum(np.bincount(columns, minlength=len(self._vocabulary)))))
+        logger.info(f"Built semantic index over {self._rows} catalog rows and {len(self._vocabulary)} n-grams")
+
+    def to_state(self):
+        """(JSON-serializable values, numpy arrays) making up the index"""
+        return {'rows': self._rows, 'vocabulary': list(self._vocabulary)}, \
+            {'idf': self._idf, 'indices': self._indices, 'data': self._data, 'indptr': self._indptr}
+
+    @classmethod
+    def from_state(cls, state, arrays):
+        matcher = cls.__new__(cls)
+        matcher._rows = state['rows']
+        matcher._vocabulary = {gram: gram_id for gram_id, gram in enumerate(state['vocabulary'])}
+        matcher._idf = arrays['idf']
+        matcher._indices = arrays['indices']
+        matcher._data = arrays['data']
+        matcher._indptr = arrays['indptr']
+        return matcher
+
+    def _query(self, description, part_number=None):
+        """Vocabulary ids and unit-length TF-IDF weights of a query's known n-grams"""
+        grams = {gram: count for gram, count in _semantic_grams(description, part_number).items()
+                 if gram in self._vocabulary}
+        ids = np.fromiter((self._vocabulary[gram] for gram in grams), dtype=np.int64, count=len(grams))
+        query = np.fromiter(grams.values(), dtype=np.float64, count=len(grams)) * self._idf[ids]
+        return ids, (query / np.sqrt(query @ query) if len(ids) else query)
+
+    def _informative(self, ids, max_share):
+        """Mask of the n-grams whose postings are scored; all of them on small catalogs"""
+        if self._rows < 1000:
+            return np.ones(len(ids), dtype=bool)
+        return self._indptr[ids + 1] - self._indptr[ids] <= self._rows * max_share
+
+    def scores(self, description, part_number=None, max_share=0.2):
+        """Cosine similarity of a query with every catalog row, as an array indexed by row position.
+
+        Like DescriptionIndex.similar_descriptions(), on large catalogs the
+        postings of n-grams in more than max_share of rows are skipped: they
+        carry little IDF weight but dominate the work. The scores are then
+        lower bounds; best_match() rescores its candidates exactly.
+        """
+        ids, query = self._query(description, part_number)
+        informative = self._informative(ids, max_share)
+        return self._scores(ids[informative], query[informative])
+
+    def _scores(self, ids, query):
+        # Positions of all the query n-grams' postings, gathered without a Python loop
+        starts = self._indptr[ids]
+        lengths = self._indptr[ids + 1] - starts
+        postings = np.arange(lengths.sum()) + np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+        return np.bincount(self._indices[postings], weights=self._data[postings] * np.repeat(query, lengths),
+                           minlength=self._rows)
+
+    def _exact_scores(self, positions, ids, query):
+        """Scores of the rows at positions over all the query's n-grams, found by binary search"""
+        positions = positions.astype(self._indices.dtype)
+        scores = np.zeros(len(positions))
+        for gram_id, weight in zip(ids, query):
+            start, end = self._indptr[gram_id], self._indptr[gram_id + 1]
+            # Each n-gram's postings are in row order
+            found = np.searchsorted(self._indices[start:end], positions)
+            hit = found < end - start
+            hit[hit] = self._indices[start + found[hit]] == positions[hit]
+            scores[hit] += self._data[start + found[hit]] * weight
+        return scores
+
+    def best_match(self, description, part_number=None, max_share=0.2):
+        """(position, score) of the most similar catalog row, or None if nothing shares an n-gram"""
+        if not self._rows:
+            return None
+        ids, query = self._query(description, part_number)
+        informative = self._informative(ids, max_share)
+        scores = self._scores(ids[informative], query[informative])
+        if informative.all():
+            position = int(scores.argmax())
+            score = float(scores[position])
+        else:
+            # Skipped n-grams add at most the length of their part of the query to a
+            # row's score, so only rows within that of the best lower bound can win
+            skipped = query[~informative]
+            candidates = np.flatnonzero(scores >= scores.max() - np.sqrt(skipped @ skipped))
+            exact = self._exact_scores(candidates, ids, query)
+            position, score = int(candidates[exact.argmax()]), float(exact.max())
+        return (position, score) if score > 0 else None
+
+
+def _atomic_write(path, write, mode):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class Catalog:
+    """Cleaned manufacturer data together with the indexes used to match against it"""
+
+    def __init__(self, df):
+        self.df = df[CATALOG_COLUMNS]
+        self.description_index = DescriptionIndex(df['Item Description'])
+        self.part_matcher = PartNumberMatcher(df['Manufacturer Part Number'])
+        self.semantic_matcher = SemanticMatcher(df['Item Description'], df['Manufacturer Part Number'])
+
+    def save(self, path):
+        """Write the catalog to a JSON file at path plus the numpy arrays next to it as .npz.
+
+        Neither format can carry code, so loading a cache file that someone
+        else wrote is safe, unlike unpickling it.
+        """
+        semantic_state, arrays = self.semantic_matcher.to_state()
+        state = {
+            'df': self.df.to_dict(orient='split'),
+            'description_index': self.description_index.to_state(),
+            'part_matcher': self.part_matcher.to_state(),
+            'semantic_matcher': semantic_state
+        }
+        # Serialize before writing anything, then arrays first: the JSON file
+        # only appears once both are complete
+        text = json.dumps(state, default=_json_scalar)
+        _atomic_write(os.path.splitext(path)[0] + '.npz', lambda f: np.savez(f, **arrays), 'wb')
+        _atomic_write(path, lambda f: f.write(text), 'w')
+
+    @classmethod
+    def load(cls, path):
+        """Read a catalog written by save(); raises FileNotFoundError if there is none"""
+        with open(path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        with np.load(os.path.splitext(path)[0] + '.npz', allow_pickle=False) as npz:
+            arrays = {name: npz[name] for name in npz.files}
+        df = state['df']
+        catalog = cls.__new__(cls)
+        catalog.df = pd.DataFrame(df['data'], index=df['index'], columns=df['columns'])
+        catalog.description_index = DescriptionIndex.from_state(state['description_index'])
+        catalog.part_matcher = PartNumberMatcher.from_state(state['part_matcher'])
+        catalog.semantic_matcher = SemanticMatcher.from_state(state['semantic_matcher'], arrays)
+        return catalog
+
+
+def _json_scalar(value):
+    """numpy scalars and dates in catalog data as plain JSON values"""
+    if value is pd.NaT:
+        return None
+    if hasattr(value, 'item'):
+        return value.item()
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
@@ -0,0 +1,99 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image, ImageOps, UnidentifiedImageError
+from image_preprocessing import draft_box
+
+logger = logging.getLogger(__name__)
+
+HASH_SIZE = 16  # 16x16 difference hash = 256 bits
+# Photos of different labels printed on the same template can be ~30% of
+# bits apart, so only near-identical shots and re-sent copies are merged
+MAX_HASH_DISTANCE = 10
+SHARPNESS_EDGE = 1024  # Sharpness is measured on a copy downscaled to this size
+
+
+def image_fingerprint(image_path, hash_size=HASH_SIZE):
+    """(difference hash, sharpness) of an image.
+
+    The hash compares neighbouring pixels of a tiny grayscale copy, so it
+    survives re-encoding and resizing. Sharpness is the variance of the
+    Laplacian, which drops for blurred or shaken shots.
+    """
+    with Image.open(image_path) as image:
+        image.draft('L', draft_box(image.size, SHARPNESS_EDGE))
+        image = ImageOps.exif_transpose(image).convert('L')
+        image.thumbnail((SHARPNESS_EDGE, SHARPNESS_EDGE))
+        pixels = np.asarray(image, dtype=np.float32)
+        tiny = np.asarray(image.resize((hash_size + 1, hash_size), Image.LANCZOS), dtype=np.int16)
+
+    bits = (tiny[:, 1:] > tiny[:, :-1]).flatten()
+    image_hash = int.from_bytes(np.packbits(bits).tobytes(), 'big')
+    laplacian = (4 * pixels[1:-1, 1:-1] - pixels[:-2, 1:-1] - pixels[2:, 1:-1]
+                 - pixels[1:-1, :-2] - pixels[1:-1, 2:])
+    return image_hash, float(laplacian.var())
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count('1')
+
+
+def cluster_duplicates(image_files, max_distance=MAX_HASH_DISTANCE, max_workers=4, fingerprints=None):
+    """Group near-identical photos.
+
+    Returns a list of clusters in order of each cluster's first file. Each
+    cluster lists its sharpest image first, then its other files in input
+    order. Images that cannot be read form their own cluster.
+
+    `fingerprints` maps image files to their (hash, sharpness) when already
+    known, e.g. from an earlier run; only the other images are read, and
+    their fingerprints are added to it.
+    """
+    def fingerprint(image_file):
+        try:
+            return image_fingerprint(image_file)
+        except (IOError, UnidentifiedImageError) as e:
+            logger.warning(f"Cannot fingerprint {image_file}: {str(e)}")
+            return None
+
+    known = fingerprints if fingerprints is not None else {}
+    to_read = [image_file for image_file in image_files if image_file not in known]
+    if len(to_read) < len(image_files):
+        logger.info(f"Fingerprinting {len(to_read)} new or changed of {len(image_files)} photos")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for image_file, result in zip(to_read, executor.map(fingerprint, to_read)):
+            if result is not None:
+                known[image_file] = result
+    fingerprints = [known.get(image_file) for image_file in image_files]
+
+    # Union-find over every pair within max_distance
+    parent = list(range(len(image_files)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in range(len(image_files)):
+        if fingerprints[i] is None:
+            continue
+        for j in range(i + 1, len(image_files)):
+            if fingerprints[j] is not None and \
+                    hamming_distance(fingerprints[i][0], fingerprints[j][0]) <= max_distance:
+                parent[find(j)] = find(i)
+
+    members = {}
+    for i in range(len(image_files)):
+        members.setdefault(find(i), []).append(i)
+
+    clusters = []
+    for indexes in sorted(members.values()):
+        sharpest = max(indexes, key=lambda i: fingerprints[i][1] if fingerprints[i] else -1)
+        clusters.append([image_files[sharpest]] + [image_files[i] for i in indexes if i != sharpest])
+        if len(indexes) > 1:
+            logger.info(f"Near-duplicate photos: keeping {os.path.basename(image_files[sharpest])}, skipping "
+                        f"{', '.join(os.path.basename(image_files[i]) for i in indexes if i != sharpest)}")
+    return clusters
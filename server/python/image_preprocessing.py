@@ -0,0 +1,82 @@
+import logging
+import os
+import time
+from dataclasses import dataclass
+from io import BytesIO
+from PIL import Image, ImageOps
+from run_metrics import NO_METRICS
+
+logger = logging.getLogger(__name__)
+
+MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+
+
+@dataclass(frozen=True)
+class PreprocessOptions:
+    """How photos are shrunk and re-encoded before being sent to the vision model"""
+    max_edge: int = 1600
+    image_format: str = 'JPEG'
+    quality: int = 85
+    grayscale: bool = False
+    normalize_contrast: bool = False
+
+    def cache_tag(self):
+        """Stable string identifying these options, for use in cache keys"""
+        return (f"max_edge={self.max_edge};format={self.image_format};quality={self.quality};"
+                f"grayscale={self.grayscale};normalize={self.normalize_contrast}")
+
+
+def draft_box(size, max_edge):
+    """Box to pass to Image.draft() so an image of `size` can shrink to fit max_edge.
+
+    draft() only scales down while both dimensions stay at least the box,
+    so a square box would keep a 4:3 photo at full size.
+    """
+    width, height = size
+    longest = max(width, height)
+    return max(1, max_edge * width // longest), max(1, max_edge * height // longest)
+
+
+def preprocess_image(image_path, options=None, metrics=NO_METRICS):
+    """Load, orient, downscale and re-encode an image.
+
+    Returns (encoded_bytes, mime_type). Raises IOError/UnidentifiedImageError
+    for unreadable files, like Image.open().
+    """
+    options = options or PreprocessOptions()
+    image_format = options.image_format.upper()
+    if image_format not in MIME_TYPES:
+        raise ValueError(f"Unsupported image format: {options.image_format}")
+
+    original_size = os.path.getsize(image_path)
+    decode_start = time.perf_counter()
+    with Image.open(image_path) as image:
+        if image.format == 'JPEG' and options.max_edge:
+            # Let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while decoding
+            image.draft('RGB', draft_box(image.size, options.max_edge))
+        image = ImageOps.exif_transpose(image)
+
+        if options.max_edge:
+            image.thumbnail((options.max_edge, options.max_edge), Image.LANCZOS)
+
+        if options.grayscale:
+            image = ImageOps.grayscale(image)
+        elif image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        if options.normalize_contrast:
+            image = ImageOps.autocontrast(image, cutoff=1)
+
+        encode_start = time.perf_counter()
+        metrics.add_time('image_decode', encode_start - decode_start)
+        byte_stream = BytesIO()
+        if image_format == 'PNG':
+            image.save(byte_stream, format='PNG', optimize=True)
+        else:
+            image.save(byte_stream, format=image_format, quality=options.quality, optimize=True)
+        encoded = byte_stream.getvalue()
+        metrics.add_time('image_encode', time.perf_counter() - encode_start)
+
+    logger.info(f"Preprocessed {os.path.basename(image_path)}: {original_size} -> {len(encoded)} bytes "
+                f"({image.width}x{image.height} {image_format})")
+    return encoded, MIME_TYPES[image_format]
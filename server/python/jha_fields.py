@@ -0,0 +1,146 @@
+import re
+
+# Bump whenever parse_jha_fields() output changes, so cached local parses are redone
+PARSER_VERSION = 1
+
+HAZARD_SECTION = 'JOB SITE WORK / HAZARD IDENTIFICATION AND CONTROLS'
+PERSONS_SECTION = 'ON SITE PERSONS'
+
+# Headings that end the hazard list on the standard template
+HAZARD_SECTION_END = ('ADDITIONAL HAZARDS', 'TRAUMA CENTERS', 'PRE-JOB CHECKLIST')
+
+CHECKED_MARKS = ('☒', '☑', '✔', '✓', '[X]', '(X)')
+UNCHECKED_MARKS = ('☐', '[ ]', '( )')
+CHECKED_FIELD_VALUES = ('/YES', '/ON', 'YES', 'ON', 'TRUE', '1', 'X')
+
+PERSON_NAME = re.compile(r'^NAME\s+(.+)$')
+NWSA_LINE = re.compile(r'^NWSA CERT#\s*\(IF CERTIFIED\)\s*(.*)$')
+NWSA_NUMBER = re.compile(r'^[A-Z0-9-]*\d[A-Z0-9-]*$')
+
+
+def _normalize(text):
+    return re.sub(r'[ \t]+', ' ', text.upper().replace('\u00a0', ' '))
+
+
+def _compact(text):
+    return re.sub(r'[^A-Z]', '', text.upper())
+
+
+def _section_bounds(lines, start_heading, end_headings=()):
+    """(start, end) line indexes of a section, heading included, or None if the heading is missing"""
+    start_key = _compact(start_heading)
+    end_keys = [_compact(heading) for heading in end_headings]
+    for start, line in enumerate(lines):
+        if _compact(line) == start_key:
+            end = next((i for i in range(start + 1, len(lines)) if _compact(lines[i]) in end_keys), len(lines))
+            return start, end
+    return None
+
+
+def _section(lines, start_heading, end_headings=()):
+    """Lines after start_heading up to the first of end_headings, or None if the heading is missing"""
+    bounds = _section_bounds(lines, start_heading, end_headings)
+    return lines[bounds[0] + 1:bounds[1]] if bounds else None
+
+
+def extract_sections(text):
+    """Only the parts of a JHA the fields are read from.
+
+    Returns the hazard identification list and the on-site persons section,
+    headings included, dropping the rest of the template (job details,
+    trauma centers, checklists, weather). Returns text unchanged if neither
+    heading is found, e.g. for a PDF that is not on the standard template.
+    """
+    lines = (text or '').splitlines()
+    normalized = _normalize(text or '').splitlines()
+    sections = []
+    for heading, end_headings in ((HAZARD_SECTION, HAZARD_SECTION_END), (PERSONS_SECTION, ())):
+        bounds = _section_bounds(normalized, heading, end_headings)
+        if bounds:
+            sections.append('\n'.join(line for line in lines[bounds[0]:bounds[1]] if line.strip()))
+    return '\n\n'.join(sections) if sections else text
+
+
+def _working_at_heights_from_fields(form_fields):
+    """Checkbox state from PDF form fields, or None if there is no such field"""
+    for name, value in (form_fields or {}).items():
+        if 'WORKINGATHEIGHTS' in _compact(name):
+            return str(value).strip().upper() in CHECKED_FIELD_VALUES
+    return None
+
+
+def _working_at_heights_from_text(hazard_lines):
+    """(checked, confidence) for the hazard list's "Working at heights" entry.
+
+    On the standard template only checked hazards are followed by an
+    indented "-HAZARD MITIGATED BY ..." line; other templates print a
+    checkbox glyph next to the label.
+    """
+    for i, line in enumerate(hazard_lines):
+        stripped = line.strip()
+        if 'WORKING AT HEIGHTS' not in stripped:
+            continue
+        if any(mark in stripped for mark in CHECKED_MARKS):
+            return True, 1.0
+        if any(mark in stripped for mark in UNCHECKED_MARKS):
+            return False, 1.0
+        if _compact(stripped) != 'WORKINGATHEIGHTS':
+            # Label with unrecognized decoration around it
+            return False, 0.3
+        following = hazard_lines[i + 1].strip() if i + 1 < len(hazard_lines) else ''
+        return following.startswith('-HAZARD MITIGATED'), 1.0
+    return False, 0.0
+
+
+def _persons(person_lines):
+    """([{name, nwsa_number}], confidence) from the ON SITE PERSONS section"""
+    persons = []
+    complete_blocks = 0
+    for line in person_lines:
+        line = line.strip()
+        name = PERSON_NAME.match(line)
+        if name:
+            # Drop the trailing "(COMPANY)" the template appends to names
+            persons.append({'name': re.sub(r'\s*\([^)]*\)\s*$', '', name.group(1)).strip(), 'nwsa_number': None})
+            continue
+        nwsa = NWSA_LINE.match(line)
+        if nwsa and persons:
+            value = nwsa.group(1).strip()
+            if value and not NWSA_NUMBER.match(value):
+                # Something other than a certificate number ended up on this line
+                return persons, 0.5
+            persons[-1]['nwsa_number'] = value or None
+            complete_blocks += 1
+    if not persons:
+        return persons, 0.0
+    return persons, 1.0 if complete_blocks == len(persons) else 0.5
+
+
+def parse_jha_fields(text, form_fields=None):
+    """Extract the JHA fields locally from PDF text and form fields.
+
+    Returns (data, confidence) where data has the same keys as
+    parse_pdf_with_ai() (working_at_heights, persons, total_persons) and
+    confidence is between 0 and 1; callers should fall back to the model
+    when it is low.
+    """
+    lines = [line for line in _normalize(text or '').splitlines() if line.strip()]
+
+    working_at_heights = _working_at_heights_from_fields(form_fields)
+    heights_confidence = 1.0
+    if working_at_heights is None:
+        hazard_lines = _section(lines, HAZARD_SECTION, HAZARD_SECTION_END)
+        if hazard_lines is None:
+            working_at_heights, heights_confidence = False, 0.0
+        else:
+            working_at_heights, heights_confidence = _working_at_heights_from_text(hazard_lines)
+
+    person_lines = _section(lines, PERSONS_SECTION)
+    persons, persons_confidence = _persons(person_lines) if person_lines is not None else ([], 0.0)
+
+    data = {
+        'working_at_heights': working_at_heights,
+        'persons': persons,
+        'total_persons': len(persons)
+    }
+    return data, min(heights_confidence, persons_confidence)
@@ -0,0 +1,171 @@
+"""Local stand-in for the OpenAI chat completions endpoint, for offline benchmarks.
+
+Point a processor at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1 and
+any OPENAI_API_KEY. It answers the three kinds of requests the processors
+send:
+
+- Vision extraction: one entry of --responses (a JSON list of extracted
+  items, or of lists of items), chosen by a hash of the image payload so the
+  same photo always gets the same answer.
+- Batched description matching: the first candidate of every ITEM.
+- JHA parsing: a fixed JHA record.
+
+Every response waits --latency_ms (with +/- --jitter) and a --rate_limit
+fraction of requests are rejected with a 429 and a Retry-After header.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+JHA_RESPONSE = {
+    'working_at_heights': True,
+    'persons': [{'name': 'DOE, JANE', 'nwsa_number': '12345'}, {'name': 'ROE, RICHARD', 'nwsa_number': None}],
+    'total_persons': 2
+}
+
+
+def _completion(content, model, prompt_chars):
+    return {
+        'id': f"chatcmpl-mock-{random.getrandbits(48):012x}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        # Roughly 4 characters per token, like the estimate in process_jha.py
+        'usage': {
+            'prompt_tokens': prompt_chars // 4,
+            'completion_tokens': len(content) // 4,
+            'total_tokens': (prompt_chars + len(content)) // 4
+        }
+    }
+
+
+def _batch_matches(prompt):
+    """Pick the first candidate Item Number of every ITEM in a batched matching prompt"""
+    matches = []
+    parts = re.split(r'^ITEM (\d+)$', prompt, flags=re.M)
+    for number, block in zip(parts[1::2], parts[2::2]):
+        candidates = block.split('CANDIDATE ITEMS (Item Number | Item Description):', 1)[-1].strip().splitlines()
+        item_number = candidates[0].split(' | ', 1)[0].strip() if candidates else None
+        matches.append({'item': int(number), 'item_number': item_number})
+    return {'matches': matches}
+
+
+class MockOpenAI:
+    """Canned answers plus the latency and rate-limit behaviour to simulate"""
+
+    def __init__(self, responses, latency_ms=500, jitter=0.2, rate_limit=0.0, retry_after=0.5):
+        self.responses = responses or [[]]
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.rejected = 0
+
+    def answer(self, body):
+        """(status, headers, payload) for one chat completions request"""
+        with self._lock:
+            self.requests += 1
+            rejected = random.random() < self.rate_limit
+            if rejected:
+                self.rejected += 1
+        if rejected:
+            error = {'error': {'message': 'Rate limit reached (mock)', 'type': 'requests',
+                               'param': None, 'code': 'rate_limit_exceeded'}}
+            return 429, {'retry-after': str(self.retry_after)}, error
+
+        delay = self.latency_ms / 1000.0 * random.uniform(1 - self.jitter, 1 + self.jitter)
+        time.sleep(max(delay, 0))
+
+        messages = body.get('messages', [])
+        user_content = messages[-1]['content'] if messages else ''
+        model = body.get('model', 'mock')
+        if isinstance(user_content, list):
+            image_url = next((part['image_url']['url'] for part in user_content if part.get('type') == 'image_url'), '')
+            index = int(hashlib.sha256(image_url.encode()).hexdigest(), 16) % len(self.responses)
+            content = json.dumps(self.responses[index])
+            return 200, {}, _completion(content, model, len(image_url) // 100)
+
+        system = messages[0]['content'] if messages and messages[0].get('role') == 'system' else ''
+        if 'JHA' in system:
+            content = json.dumps(JHA_RESPONSE)
+        elif 'CANDIDATE ITEMS' in user_content and body.get('response_format', {}).get('type') == 'json_object':
+            content = json.dumps(_batch_matches(user_content))
+        else:
+            content = 'null'
+        return 200, {}, _completion(content, model, len(user_content))
+
+
+def make_handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            length = int(self.headers.get('content-length') or 0)
+            try:
+                body = json.loads(self.rfile.read(length) or b'{}')
+            except ValueError:
+                body = {}
+            if not self.path.rstrip('/').endswith('/chat/completions'):
+                status, headers, payload = 404, {}, {'error': {'message': f"Unknown path {self.path}"}}
+            else:
+                status, headers, payload = mock.answer(body)
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('content-type', 'application/json')
+            self.send_header('content-length', str(len(data)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return Handler
+
+
+def start_server(mock, host='127.0.0.1', port=0):
+    """Serve mock on a background thread and return the server; server.server_port has the bound port"""
+    server = ThreadingHTTPServer((host, port), make_handler(mock))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI chat completions API.")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--responses', default=None,
+                        help='JSON file with a list of canned vision extraction answers')
+    parser.add_argument('--latency_ms', type=float, default=500, help='Mean response latency')
+    parser.add_argument('--jitter', type=float, default=0.2, help='Latency varies by +/- this fraction')
+    parser.add_argument('--rate_limit', type=float, default=0.0, help='Fraction of requests rejected with a 429')
+    parser.add_argument('--retry_after', type=float, default=0.5, help='Retry-After seconds sent with 429s')
+    args = parser.parse_args()
+
+    responses = None
+    if args.responses:
+        with open(args.responses, 'r', encoding='utf-8') as f:
+            responses = json.load(f)
+    mock = MockOpenAI(responses, args.latency_ms, args.jitter, args.rate_limit, args.retry_after)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(mock))
+    print(f"Mock OpenAI API listening on http://127.0.0.1:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -4,10 +4,12 @@ import re
 import json
 import os
 import sys
+import threading
 import traceback
-from glob import glob
-from PIL import Image, UnidentifiedImageError
-from difflib import get_close_matches
+from fnmatch import fnmatch
+from glob import glob, has_magic
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from PIL import UnidentifiedImageError
 import logging
 from datetime import datetime
 import openai
@@ -15,6 +17,14 @@ from openai import OpenAI
 from dotenv import load_dotenv
 load_dotenv()  # This loads the .env file
 import base64
+from rate_limiter import TokenBucket, call_with_backoff
+from disk_cache import DiskCache, content_key, file_sha256
+from run_journal import RunJournal, RunManifest
+from run_metrics import NO_METRICS, RunMetrics, metrics_path
+from image_preprocessing import PreprocessOptions, preprocess_image
+from image_dedupe import MAX_HASH_DISTANCE, cluster_duplicates
+import barcode_reader
+from catalog_index import Catalog, DescriptionIndex
 
 # Configure logging
 logging.basicConfig(
@@ -31,36 +41,38 @@ class EquipmentProcessorError(Exception):
     """Custom exception for equipment processing errors"""
     pass
 
-def configure_openai():
-    """Configure OpenAI API with error handling"""
-    try:
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
-            raise EquipmentProcessorError("Missing OpenAI API key")
-        
-        client = OpenAI(api_key=api_key)
-        logger.info("OpenAI API configured successfully")
-        return client
-    except Exception as e:
-        raise EquipmentProcessorError(f"OpenAI configuration failed: {str(e)}")
-
-def extract_from_image(image_path, client):
-    """You are a data and text extraction expert"""
-    try:
-        logger.info(f"Processing image: {image_path}")
-        
-        try:
-            image = Image.open(image_path)
-            # Convert image to bytes for API upload
-            from io import BytesIO
-            byte_stream = BytesIO()
-            image.save(byte_stream, format='PNG')
-            byte_data = byte_stream.getvalue()
-        except (IOError, UnidentifiedImageError) as e:
-            logger.error(f"Invalid image file: {image_path} - {str(e)}")
-            return None
-        
-        prompt = f"""
+EXTRACTION_MODEL = "o4-mini"
+
+# Minimum TF-IDF cosine similarity for accepting the offline semantic match
+SEMANTIC_THRESHOLD = 0.35
+
+# Inventory CSV columns, keyed by the matched-row field they come from
+OUTPUT_COLUMNS = {
+    'asset_tag': 'Asset Tag #',
+    'serial_number': 'Serial Number',
+    'item_number': 'Item Number',
+    'part_number': 'Mfr Part number',
+    'From location': 'From location',
+    'quantity': 'Quantity',
+    'quality': 'Quality',
+    'werf': 'WERF#',
+    'wrt': 'WRT#',
+    'toe_tag': 'Toe Tag #'
+}
+
+# Bump when Catalog or its indexes change shape so stale cache files are rebuilt
+CATALOG_CACHE_VERSION = 6
+
+# Catalogs already loaded by this process, keyed like the on-disk cache, so a
+# long-running worker keeps them warm between jobs
+_loaded_catalogs = {}
+MAX_LOADED_CATALOGS = 8
+# One lock per catalog key, so concurrent runs share one load of the same
+# file while different catalogs load in parallel; _catalog_lock guards both dicts
+_catalog_key_locks = {}
+_catalog_lock = threading.Lock()
+
+EXTRACTION_PROMPT = """
 You are an expert in structured data extraction from technical images. Extract relevant text from the image and return a structured JSON object using the following keys:
 
 ### Task
@@ -86,35 +98,88 @@ and letters from clear images and iterate over the non-clear images to have the
 Input: PBP4ACPFAA, LBGEPE16KZ05005702, ATT07025435, RECTIFIER NE050AC48ATEZ  
 Output:
 ```json
-{{
+{
   "serial_number": "LBGEPE16KZ05005702",
   "part_number": "PBP4ACPFAA",
   "asset_tag": "ATT07025435",
   "description": "Radio Rectifier NE050AC48ATEZ AX/48V 501"
-}} ```
+} ```
 
 ### Example 2
 Input: X,mm,1°,93,2°,132,4°,209,5°,248,6°,287,8°,365,10°,442,Antenna,(1P)KRE 101 2283/1,(S)T0M1049689,(1P) CS7278761.01,(S) SYZ191049689, 8-port Antena 2LB 24 65
 output:
 ```
-{{
+{
     "serial_number" : "T0M1049689",
     "part_number" : "KRE1012283/1",
     "asset_Tag" : " ",
     "description" : Antenna 8 port 65 degree
     
-}} ```
-        """
+} ```
+"""
+
+def configure_openai():
+    """Configure OpenAI API with error handling"""
+    try:
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise EquipmentProcessorError("Missing OpenAI API key")
+        
+        # Retries are handled by call_with_backoff so they go through the rate limiter
+        client = OpenAI(api_key=api_key, max_retries=0)
+        logger.info("OpenAI API configured successfully")
+        return client
+    except Exception as e:
+        raise EquipmentProcessorError(f"OpenAI configuration failed: {str(e)}")
+
+def extract_from_image(image_path, client, limiter=None, cache=None, options=None, metrics=NO_METRICS,
+                       catalog=None):
+    """You are a data and text extraction expert
+
+    If `catalog` is given, the label's barcodes are decoded first; when they
+    give a serial number, an asset tag and a part number found in the
+    catalog, the item is returned without calling the vision model.
+    """
+    try:
+        logger.info(f"Processing image: {image_path}")
+        options = options or PreprocessOptions()
+
+        cache_key = None
+        if cache is not None:
+            with open(image_path, 'rb') as f:
+                cache_key = content_key(EXTRACTION_MODEL, EXTRACTION_PROMPT, options.cache_tag(), f.read())
+            cached = cache.get(cache_key)
+            if cached is not None:
+                logger.info(f"Cache hit for image: {image_path}")
+                metrics.increment('vision_cache.hits')
+                return cached['response']
+            metrics.increment('vision_cache.misses')
+
+        if catalog is not None and barcode_reader.available():
+            barcode_item = extract_from_barcodes(image_path, catalog, metrics)
+            if barcode_item is not None:
+                return json.dumps(barcode_item)
+
+        try:
+            byte_data, mime_type = preprocess_image(image_path, options, metrics)
+        except (IOError, UnidentifiedImageError) as e:
+            logger.error(f"Invalid image file: {image_path} - {str(e)}")
+            return None
+        
         encoded_image = base64.b64encode(byte_data).decode("utf-8")
 
-        response = client.chat.completions.create(
-            model="o4-mini",
+        response = call_with_backoff(
+            client.chat.completions.create,
+            limiter=limiter,
+            metrics=metrics,
+            label='vision_extraction',
+            model=EXTRACTION_MODEL,
             messages=[
                 {
                     "role": "user",
                     "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{encoded_image}"}},
+                        {"type": "text", "text": EXTRACTION_PROMPT},
+                        {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{encoded_image}"}},
                     ],
                 }
             ],
@@ -124,11 +189,47 @@ output:
         if not response.choices or not response.choices[0].message.content:
             logger.warning(f"No content returned from OpenAI for image: {image_path}")
             return None
-        return response.choices[0].message.content
+        content = response.choices[0].message.content
+        if parse_extraction(content, image_path) is None:
+            # Not cached, so the next run asks again
+            return None
+        if cache_key is not None:
+            cache.set(cache_key, {'response': content, 'image_file': os.path.basename(image_path)})
+        return content
     except Exception as e:
         logger.error(f"OpenAI processing failed for {image_path}: {str(e)}")
         return None
 
+def extract_from_barcodes(image_path, catalog, metrics=NO_METRICS):
+    """Item read from the label's barcodes, or None if they don't identify it.
+
+    The serial number, part number and ATT asset tag must all decode
+    unambiguously, so the model would have nothing left to read but the
+    description, and the part number must match the catalog exactly, so the
+    row needs no description to be matched.
+    """
+    with metrics.timer('barcode_decode'):
+        try:
+            fields = barcode_reader.read_label_fields(image_path)
+        except Exception as e:
+            logger.warning(f"Barcode decoding failed for {image_path}: {str(e)}")
+            fields = {}
+
+    if not fields.get('serial_number') or not fields.get('part_number') or not fields.get('asset_tag') or \
+            pd.isna(catalog.part_matcher.exact_positions([fields['part_number']]).iloc[0]):
+        metrics.increment('barcode.incomplete')
+        return None
+
+    metrics.increment('barcode.hits')
+    logger.info(f"Read serial {fields['serial_number']}, part number {fields['part_number']} and asset tag "
+                f"{fields['asset_tag']} from barcodes in {image_path}, skipping the vision model")
+    return {
+        'serial_number': fields['serial_number'],
+        'part_number': fields['part_number'],
+        'asset_tag': fields['asset_tag'],
+        'description': None
+    }
+
 def clean_json_response(response_text):
     """Clean OpenAI response JSON"""
     try:
@@ -138,7 +239,29 @@ def clean_json_response(response_text):
         logger.error(f"Error cleaning JSON response: {str(e)}")
         return None
 
-def ai_description_matcher(extracted_desc, df_manufacturers, client):
+def parse_extraction(response, image_file):
+    """Turn a raw extraction response into a list of item dicts tagged with their image, or None if it isn't JSON"""
+    items = []
+    cleaned = clean_json_response(response)
+    if not cleaned:
+        logger.error(f"Empty extraction response for {image_file}")
+        return None
+    try:
+        data = json.loads(cleaned)
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON decode error in {image_file}: {e}")
+        return None
+    if isinstance(data, dict):
+        data['image_file'] = image_file
+        items.append(data)
+    elif isinstance(data, list):
+        for item in data:
+            if isinstance(item, dict):
+                item['image_file'] = image_file
+                items.append(item)
+    return items
+
+def ai_description_matcher(extracted_desc, df_manufacturers, client, index=None, metrics=NO_METRICS):
     """You are a technical equipment expert. Your task is to identify the best matching item number from a manufacturer file based on the extracted description.
 
             The match should prioritize:
@@ -146,17 +269,18 @@ def ai_description_matcher(extracted_desc, df_manufacturers, client):
             - Functional and keyword similarity (e.g., radio, antenna, rectifier)
             - Ignoring irrelevant differences"""
     try:
+        if index is None:
+            index = DescriptionIndex(df_manufacturers['Item Description'])
+
         # First try exact matches in the description
-        for _, row in df_manufacturers.iterrows():
-            if pd.notna(row['Item Description']) and str(row['Item Description']).lower() in extracted_desc.lower():
-                return row['Item Number']
-        
+        matches = index.substring_matches(extracted_desc)
+        if matches:
+            return df_manufacturers.iloc[matches[0][0]]['Item Number']
+
         # Then try partial matches
-        for _, row in df_manufacturers.iterrows():
-            if pd.notna(row['Item Description']):
-                desc_words = str(row['Item Description']).lower().split()
-                if any(word in extracted_desc.lower() for word in desc_words if len(word) > 3):
-                    return row['Item Number']
+        matches = index.keyword_matches(extracted_desc)
+        if matches:
+            return df_manufacturers.iloc[matches[0][0]]['Item Number']
         
         # Only use API if no matches found
         prompt = f"""
@@ -172,7 +296,10 @@ CANDIDATE ITEMS (Item Number | Item Description):
     3. Manufacturer/model compatibility
         """
         
-        response = client.chat.completions.create(
+        response = call_with_backoff(
+            client.chat.completions.create,
+            metrics=metrics,
+            label='ai_description_match',
             model="o4-mini",  # Use cheaper model for this task
             messages=[
                 {"role": "system", "content": "You are a helpful assistant that matches technical equipment descriptions."},
@@ -187,6 +314,354 @@ CANDIDATE ITEMS (Item Number | Item Description):
         logger.error(f"AI matching error: {str(e)}")
         return None
 
+def ai_batch_description_matcher(descriptions, catalog, client, limiter=None, batch_size=20, top_k=10,
+                                 metrics=NO_METRICS):
+    """Resolve many unmatched descriptions with one structured request per batch.
+
+    `descriptions` is a list of (key, extracted_desc). Each description is
+    sent with only its top_k most similar catalog rows instead of the whole
+    catalog. Returns {key: item_number} for answers that name a real
+    catalog Item Number.
+    """
+    df_manufacturers = catalog.df
+    item_numbers = {str(value).strip(): value for value in df_manufacturers['Item Number'].dropna()}
+    matches = {}
+
+    for start in range(0, len(descriptions), batch_size):
+        batch = []
+        for key, extracted_desc in descriptions[start:start + batch_size]:
+            shortlist = catalog.description_index.similar_descriptions(extracted_desc, top_k)
+            if shortlist:
+                candidates = df_manufacturers.iloc[[position for position, _ in shortlist]]
+                batch.append((key, extracted_desc, candidates))
+        if not batch:
+            continue
+
+        sections = []
+        for number, (_, extracted_desc, candidates) in enumerate(batch, start=1):
+            lines = '\n'.join(f"{item} | {desc}" for item, desc in
+                              candidates[['Item Number', 'Item Description']].itertuples(index=False))
+            sections.append(f"""ITEM {number}
+EXTRACTED DESCRIPTION: {extracted_desc}
+CANDIDATE ITEMS (Item Number | Item Description):
+{lines}""")
+
+        prompt = """For each ITEM below, choose the best matching Item Number from its CANDIDATE ITEMS considering:
+    1. Manufacturer Item Description with item description
+    2. Functional equivalence
+    3. Manufacturer/model compatibility
+
+Return JSON of the form {"matches": [{"item": <ITEM number>, "item_number": "<Item Number or null>"}]}
+with one entry per ITEM. Use null when no candidate fits.
+
+""" + "\n\n".join(sections)
+
+        try:
+            response = call_with_backoff(
+                client.chat.completions.create,
+                limiter=limiter,
+                metrics=metrics,
+                label='ai_batch_match',
+                model="o4-mini",
+                messages=[
+                    {"role": "system", "content": "You are a helpful assistant that matches technical equipment descriptions."},
+                    {"role": "user", "content": prompt}
+                ],
+                response_format={"type": "json_object"},
+                max_completion_tokens=1000 + 100 * len(batch)
+            )
+            answers = json.loads(response.choices[0].message.content).get('matches', [])
+        except Exception as e:
+            logger.error(f"Batched AI matching error: {str(e)}")
+            continue
+
+        for answer in answers:
+            if not isinstance(answer, dict):
+                continue
+            try:
+                number = int(answer.get('item'))
+            except (TypeError, ValueError):
+                continue
+            item_number = str(answer.get('item_number') or '').strip().strip('"')
+            if 1 <= number <= len(batch) and item_number in item_numbers:
+                matches[batch[number - 1][0]] = item_numbers[item_number]
+
+        logger.info(f"Batched AI matching resolved {len(matches)} of {start + len(batch)} descriptions so far")
+
+    return matches
+
+def _set_match(matched, item_number, method, score):
+    matched['item_number'] = item_number
+    matched['match_method'] = method
+    matched['match_score'] = score
+
+def _fuzzy_part_number_match(matched, catalog, metrics=NO_METRICS):
+    """Stage 3: Fuzzy match on part number"""
+    with metrics.timer('match.fuzzy_part_number'):
+        close_match = catalog.part_matcher.fuzzy_match(matched['part_number'], cutoff=0.7)
+    if close_match:
+        _set_match(matched, catalog.df.iloc[close_match[0]]['Item Number'], 'fuzzy_part_number', close_match[1])
+    else:
+        _set_match(matched, None, 'no_match', 0.0)
+
+def match_items_locally(df_extracted, catalog, client, ai_batch_size=20, metrics=NO_METRICS,
+                        semantic_threshold=SEMANTIC_THRESHOLD):
+    """Run the matching stages that need no batched API call.
+
+    Returns (matched_data, pending_ai): one matched row per extracted row, and
+    (row position, description) pairs still waiting for batched AI matching.
+    """
+    df_manufacturers = catalog.df
+    if 'part_number' not in df_extracted.columns:
+        df_extracted['part_number'] = None
+    df_extracted['part_number'] = df_extracted['part_number'].astype(str).str.upper().str.strip()
+
+    # Stage 1: Exact part number match, as one join over all extracted rows
+    with metrics.timer('match.exact_part_number'):
+        exact_positions = catalog.part_matcher.exact_positions(df_extracted['part_number'])
+
+    matched_data = []
+    pending_ai = []
+    for idx, row in df_extracted.iterrows():
+        matched = row.copy()
+        matched_data.append(matched)
+
+        position = exact_positions[idx]
+        if pd.notna(position):
+            _set_match(matched, df_manufacturers.iloc[int(position)]['Item Number'], 'exact_part_number', 1.0)
+            continue
+
+        # Stage 2: Try to find in description without API call
+        if pd.notna(row.get('description')):
+            # First try exact matches in manufacturer descriptions, longest description first
+            with metrics.timer('match.description'):
+                desc_matches = catalog.description_index.substring_matches(row['description'])
+            if desc_matches:
+                _set_match(matched, df_manufacturers.iloc[desc_matches[0][0]]['Item Number'],
+                           'exact_description_match', desc_matches[0][1])
+                continue
+
+            # Then the offline TF-IDF similarity, when it is confident enough
+            if semantic_threshold:
+                with metrics.timer('match.semantic'):
+                    semantic = catalog.semantic_matcher.best_match(row['description'], row['part_number'])
+                if semantic and semantic[1] >= semantic_threshold:
+                    _set_match(matched, df_manufacturers.iloc[semantic[0]]['Item Number'],
+                               'semantic_description_match', semantic[1])
+                    continue
+
+            # Same local keyword fallback ai_description_matcher() applies before its API call
+            with metrics.timer('match.keyword'):
+                keyword_matches = catalog.description_index.keyword_matches(row['description'])
+            if keyword_matches:
+                _set_match(matched, df_manufacturers.iloc[keyword_matches[0][0]]['Item Number'],
+                           'keyword_description_match', None)
+                continue
+
+            if ai_batch_size:
+                pending_ai.append((len(matched_data) - 1, row['description']))
+                continue
+
+            # Only use API if no matches found
+            ai_match = ai_description_matcher(row['description'], df_manufacturers, client, catalog.description_index,
+                                              metrics)
+            if ai_match and ai_match in df_manufacturers['Item Number'].values:
+                _set_match(matched, ai_match, 'ai_description_match', None)
+                continue
+
+        _fuzzy_part_number_match(matched, catalog, metrics)
+
+    return matched_data, pending_ai
+
+class InventoryWriter:
+    """Streams inventory rows to the output CSV in image order as soon as each image's rows are final"""
+
+    def __init__(self, output_path, location, image_files):
+        self.output_path = output_path
+        self.location = location
+        self.row_count = 0
+        self._order = list(image_files)
+        self._next = 0
+        self._ready = {}
+        self._file = open(output_path, 'w', newline='', encoding='utf-8')
+        pd.DataFrame(columns=list(OUTPUT_COLUMNS.values())).to_csv(self._file, index=False)
+        self._file.flush()
+
+    def add(self, image_file, matched_rows):
+        self._ready[image_file] = matched_rows
+        # Write every image whose predecessors are all written
+        while self._next < len(self._order) and self._order[self._next] in self._ready:
+            rows = self._ready.pop(self._order[self._next])
+            if rows:
+                build_output(pd.DataFrame(rows), self.location).to_csv(self._file, header=False, index=False)
+                self._file.flush()
+                self.row_count += len(rows)
+            self._next += 1
+
+    def close(self):
+        self._file.close()
+
+def _image_sha256(image_file, entry):
+    """Content hash of an image, trusting a recorded hash while size and mtime are unchanged"""
+    stat = os.stat(image_file)
+    if entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns and entry.get('sha256'):
+        return entry['sha256']
+    return file_sha256(image_file)
+
+def process_images(image_files, catalog, client, args, limiter=None, cache=None, options=None,
+                   journal=None, writer=None, previous=None, metrics=NO_METRICS, executor=None):
+    """Extract and match every image.
+
+    Extraction runs on a thread pool, `executor` if given (e.g. one shared
+    by several locations), else one of args.max_workers threads. Each
+    completed image is journaled and
+    matched locally right away; rows needing AI are batched across images.
+    An image's rows go to the journal and writer as soon as they are final.
+
+    `previous` maps image names to earlier state ({'sha256', 'items'} and,
+    once matched, 'rows') from an interrupted run or the location manifest.
+    Images whose content is unchanged are not extracted, or matched, again.
+
+    Images whose extraction fails (API error, unparseable answer) are not
+    journaled, so a resumed or incremental run extracts them again.
+
+    Returns {image_file: {'sha256', 'items', 'rows'}} in image order; failed
+    images get {'sha256', 'failed': True} instead.
+    """
+    previous = previous or {}
+    state = {image_file: {} for image_file in image_files}
+    pending_images = []  # (image_file, matched rows, [(row position, description)])
+
+    def finish(image_file, matched_rows):
+        state[image_file]['rows'] = matched_rows
+        if journal is not None:
+            journal.record_match(os.path.basename(image_file), state[image_file]['sha256'], matched_rows)
+        if writer is not None:
+            writer.add(image_file, matched_rows)
+
+    def flush_ai():
+        requests = [((i, position), description)
+                    for i, (_, _, pending) in enumerate(pending_images)
+                    for position, description in pending]
+        with metrics.timer('match.ai_batch'):
+            ai_matches = ai_batch_description_matcher(requests, catalog, client, limiter, args.ai_batch_size,
+                                                      args.ai_top_k, metrics)
+        for i, (image_file, matched_rows, pending) in enumerate(pending_images):
+            for position, _ in pending:
+                if (i, position) in ai_matches:
+                    _set_match(matched_rows[position], ai_matches[(i, position)], 'ai_description_match', None)
+                else:
+                    _fuzzy_part_number_match(matched_rows[position], catalog, metrics)
+            finish(image_file, matched_rows)
+        pending_images.clear()
+
+    def match(image_file, items):
+        state[image_file]['items'] = items
+        if not items:
+            finish(image_file, [])
+            return
+        matched_rows, pending = match_items_locally(pd.DataFrame(items), catalog, client, args.ai_batch_size, metrics,
+                                                    args.semantic_threshold)
+        if not pending:
+            finish(image_file, matched_rows)
+            return
+        pending_images.append((image_file, matched_rows, pending))
+        if sum(len(p) for _, _, p in pending_images) >= args.ai_batch_size:
+            flush_ai()
+
+    def extract(image_file):
+        """Extracted items, or None if extraction failed"""
+        response = extract_from_image(image_file, client, limiter, cache, options, metrics,
+                                      None if args.no_barcodes else catalog)
+        return parse_extraction(response, image_file) if response else None
+
+    to_extract = []
+    for image_file in image_files:
+        entry = previous.get(os.path.basename(image_file), {})
+        state[image_file]['sha256'] = _image_sha256(image_file, entry)
+        if entry.get('sha256') != state[image_file]['sha256']:
+            to_extract.append(image_file)
+        elif 'rows' in entry:
+            # Already final earlier; write without journaling again
+            state[image_file].update(items=entry.get('items', []), rows=entry['rows'])
+            if writer is not None:
+                writer.add(image_file, entry['rows'])
+        else:
+            match(image_file, entry['items'])
+    if previous:
+        logger.info(f"{len(image_files) - len(to_extract)} of {len(image_files)} images already extracted, "
+                    f"{len(to_extract)} new or changed")
+    metrics.increment('images.total', len(image_files))
+    metrics.increment('images.extracted', len(to_extract))
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=args.max_workers)
+    futures = {}
+    try:
+        futures = {executor.submit(extract, image_file): image_file for image_file in to_extract}
+        for future in as_completed(futures):
+            image_file = futures[future]
+            items = future.result()
+            if items is None:
+                state[image_file]['failed'] = True
+                metrics.increment('images.failed')
+                if writer is not None:
+                    writer.add(image_file, [])
+                continue
+            if journal is not None:
+                journal.record_extraction(os.path.basename(image_file), state[image_file]['sha256'], items)
+            match(image_file, items)
+    finally:
+        if own_executor:
+            executor.shutdown(cancel_futures=True)
+        else:
+            # Don't leave a failed run's extractions queued on a shared pool
+            for future in futures:
+                future.cancel()
+
+    if pending_images:
+        flush_ai()
+
+    failed = [os.path.basename(image_file) for image_file, entry in state.items() if entry.get('failed')]
+    if failed:
+        logger.warning(f"Extraction failed for {len(failed)} images, they will be retried on the next run: "
+                       f"{', '.join(failed)}")
+
+    if cache is not None:
+        stats = cache.stats()
+        logger.info(f"Extraction cache: {stats['hits']} hits, {stats['misses']} misses")
+
+    for entry in state.values():
+        for row in entry.get('rows', []):
+            metrics.increment(f"match_method.{row.get('match_method') or 'no_match'}")
+
+    return state
+
+def _item_number_text(value):
+    """Item Number as written to the CSV, so 100991 never appears as 100991.0"""
+    if pd.isna(value):
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def build_output(df_final, location):
+    """Shape matched rows into the inventory CSV layout"""
+    df_final['From location'] = location
+
+    # Every column is always present so streamed chunks share one header
+    df_output = df_final.reindex(columns=list(OUTPUT_COLUMNS))
+    df_output = df_output.rename(columns=OUTPUT_COLUMNS)
+    # Each chunk holds one image's rows, so its dtype alone can't decide how numbers print
+    df_output['Item Number'] = df_output['Item Number'].map(_item_number_text)
+    df_output['Quantity'] = 1
+    df_output['Quality'] = 'Good'
+    df_output['WERF#'] = ' '
+    df_output['WRT#'] = ' '
+    df_output['Toe Tag #'] = ' '
+    return df_output
+
 def load_manufacturer_data(file_path):
     """Load manufacturer data"""
     try:
@@ -198,156 +673,304 @@ def load_manufacturer_data(file_path):
             if req_col not in df.columns:
                 raise EquipmentProcessorError(f"Missing required column in manufacturer file: {req_col}")
 
+        df['Manufacturer Part Number'] = df['Manufacturer Part Number'].astype(str).str.upper().str.strip()
         return df
     except Exception as e:
         raise EquipmentProcessorError(f"Error loading manufacturer data: {str(e)}")
 
+def _remember_catalog(key, catalog):
+    catalog.key = key
+    with _catalog_lock:
+        if len(_loaded_catalogs) >= MAX_LOADED_CATALOGS:
+            _loaded_catalogs.pop(next(iter(_loaded_catalogs)))
+        _loaded_catalogs[key] = catalog
+    return catalog
+
+def load_catalog(file_path, cache_dir=None, metrics=NO_METRICS):
+    """Load manufacturer data and its matching indexes.
+
+    The parsed catalog is kept in memory and saved under cache_dir, keyed
+    by the file's content hash, so repeat runs, and other locations uploading
+    an identical file, skip read_excel and index building.
+    """
+    key = content_key(str(CATALOG_CACHE_VERSION), file_sha256(file_path))
+    with _catalog_lock:
+        key_lock = _catalog_key_locks.setdefault(key, threading.Lock())
+    with key_lock:
+        return _load_catalog(file_path, key, cache_dir, metrics)
+
+def _load_catalog(file_path, key, cache_dir, metrics):
+    with _catalog_lock:
+        loaded = _loaded_catalogs.get(key)
+    if loaded is not None:
+        logger.info(f"Reusing loaded catalog for {file_path}")
+        metrics.increment('catalog_cache.memory_hits')
+        return loaded
+
+    if not cache_dir:
+        metrics.increment('catalog_cache.misses')
+        return _remember_catalog(key, Catalog(load_manufacturer_data(file_path)))
+
+    catalog_dir = os.path.join(cache_dir, 'catalog')
+    cache_path = os.path.join(catalog_dir, f"{key}.json")
+    try:
+        catalog = Catalog.load(cache_path)
+        logger.info(f"Loaded cached catalog for {file_path}")
+        metrics.increment('catalog_cache.disk_hits')
+        return _remember_catalog(key, catalog)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"Ignoring unreadable catalog cache {cache_path}: {str(e)}")
+
+    metrics.increment('catalog_cache.misses')
+    catalog = _remember_catalog(key, Catalog(load_manufacturer_data(file_path)))
+    try:
+        os.makedirs(catalog_dir, exist_ok=True)
+        catalog.save(cache_path)
+        logger.info(f"Cached parsed catalog at {cache_path}")
+    except (OSError, TypeError, ValueError) as e:
+        logger.warning(f"Could not cache catalog for {file_path}: {str(e)}")
+    return catalog
+
+def resolve_output_path(output_path):
+    """Final CSV path for an --output argument, creating its directory"""
+    output_dir = os.path.dirname(output_path)
+
+    # Ensure the path ends with .csv
+    if not output_path.lower().endswith('.csv'):
+        output_path = os.path.join(output_dir, 'output', 'equipment_inventory.csv')
+
+    # Create directory if it doesn't exist
+    if os.path.dirname(output_path):  # Only create if path has a directory
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    return output_path
+
 def save_results(df, output_path):
     """Save final output CSV with proper path handling"""
     try:
-        # Create directory if it doesn't exist
-        output_dir = os.path.dirname(output_path)
-        if output_dir:  # Only create if path has a directory
-            os.makedirs(output_dir, exist_ok=True)
-        
-        # Ensure the path ends with .csv
-        if not output_path.lower().endswith('.csv'):
-            output_path = os.path.join(output_dir, 'output', 'equipment_inventory.csv')
-        
+        output_path = resolve_output_path(output_path)
         df.to_csv(output_path, index=False)
         logger.info(f"Results saved to: {output_path}")
+        return output_path
     except Exception as e:
         raise EquipmentProcessorError(f"Failed to save results: {str(e)}")
 
+def build_arg_parser():
+    """Command-line options for a processing run (also used to parse worker job options)"""
+    parser = argparse.ArgumentParser()
+    locations = parser.add_mutually_exclusive_group(required=True)
+    locations.add_argument('--location')
+    locations.add_argument('--locations', nargs='+',
+                           help='Batch mode: location names or glob patterns (e.g. "12*") matched against '
+                                '<uploads_root>/photos; writes equipment_inventory_<location>.csv per location')
+    parser.add_argument('--output', required=True,
+                        help='Inventory CSV path, or in batch mode the directory for the per-location CSVs')
+    parser.add_argument('--uploads_root', required=True)
+    parser.add_argument('--max_workers', type=int, default=int(os.getenv('EXTRACTION_WORKERS', 4)),
+                        help='Number of images extracted concurrently')
+    parser.add_argument('--requests_per_minute', type=float, default=float(os.getenv('OPENAI_REQUESTS_PER_MINUTE', 60)),
+                        help='Upper bound on OpenAI requests started per minute')
+    parser.add_argument('--cache_dir', default=None,
+                        help='Directory for cached extraction results (default: <uploads_root>/.cache)')
+    parser.add_argument('--cache_max_mb', type=int, default=500,
+                        help='Size limit for the extraction cache before old entries are evicted')
+    parser.add_argument('--no_cache', action='store_true', help='Always call the vision model')
+    parser.add_argument('--max_edge', type=int, default=1600,
+                        help='Downscale photos so their longest edge is at most this many pixels (0 keeps full size)')
+    parser.add_argument('--image_format', choices=['JPEG', 'WEBP', 'PNG'], type=str.upper, default='JPEG',
+                        help='Encoding used for the vision request payload')
+    parser.add_argument('--image_quality', type=int, default=85, help='JPEG/WebP encoding quality')
+    parser.add_argument('--grayscale', action='store_true', help='Send photos in grayscale')
+    parser.add_argument('--normalize_contrast', action='store_true', help='Stretch photo contrast before sending')
+    parser.add_argument('--ai_batch_size', type=int, default=20,
+                        help='Unmatched descriptions resolved per AI request (0 sends one request per row with the full catalog)')
+    parser.add_argument('--semantic_threshold', type=float, default=SEMANTIC_THRESHOLD,
+                        help='Minimum similarity for the offline semantic match before AI matching (0 disables it)')
+    parser.add_argument('--ai_top_k', type=int, default=10,
+                        help='Catalog candidates shortlisted per description in batched AI matching')
+    parser.add_argument('--no_barcodes', action='store_true',
+                        help='Send every photo to the vision model, even when its barcodes identify the item')
+    parser.add_argument('--no_dedupe', action='store_true',
+                        help='Extract every photo, even near-identical shots of the same label')
+    parser.add_argument('--dedupe_distance', type=int, default=MAX_HASH_DISTANCE,
+                        help='Photos whose 256-bit perceptual hashes differ in at most this many bits are duplicates')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted run, skipping images already recorded in its journal')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only process photos added or changed since the last completed run and merge them into its inventory')
+    parser.add_argument('--concurrent_locations', type=int, default=4,
+                        help='Batch mode: locations processed at the same time (extraction threads stay at --max_workers)')
+    return parser
+
+def run(args, client=None, limiter=None, metrics=None, executor=None):
+    """Process one location and return the path of the saved inventory CSV.
+
+    A long-running caller (see worker.py) passes its own client and limiter
+    so they are shared between runs, and run_batch() also shares its
+    extraction executor. The run's metrics summary is written next to the
+    CSV as <name>.metrics.json.
+    """
+    client = client or configure_openai()
+    metrics = metrics or RunMetrics('equipment', args.location)
+
+    photo_dir = os.path.join(args.uploads_root, 'photos', args.location)
+    image_files = sorted(glob(os.path.join(photo_dir, '*.jpg')) + \
+                         glob(os.path.join(photo_dir, '*.jpeg')) + \
+                         glob(os.path.join(photo_dir, '*.png')))
+
+    if not image_files:
+        raise EquipmentProcessorError(f"No images found in {photo_dir}")
+
+    # Load the catalog before paying for extraction so rows can be matched as images complete
+    manufacturer_dir = os.path.join(args.uploads_root, 'manufacturer', args.location)
+    manufacturer_files = glob(os.path.join(manufacturer_dir, '*.xlsx')) + glob(os.path.join(manufacturer_dir, '*.xls'))
+
+    if not manufacturer_files:
+        raise EquipmentProcessorError(f"No manufacturer files found in {manufacturer_dir}")
+
+    cache_dir = args.cache_dir or os.path.join(args.uploads_root, '.cache')
+    with metrics.timer('catalog_load'):
+        catalog = load_catalog(manufacturer_files[0], cache_dir, metrics)
+
+    run_dir = os.path.join(cache_dir, 'runs', args.location)
+    journal = RunJournal(os.path.join(run_dir, 'journal.jsonl'))
+    manifest = RunManifest(os.path.join(run_dir, 'manifest.json'))
+
+    # Extract only the sharpest of each group of near-identical photos
+    duplicates = {}
+    fingerprints = {}
+    if not args.no_dedupe:
+        # Safe on every run: only photos whose size and mtime are unchanged reuse theirs
+        fingerprints = manifest.load_fingerprints(image_files)
+        metrics.increment('images.fingerprinted', len(image_files) - len(fingerprints))
+        with metrics.timer('dedupe'):
+            clusters = cluster_duplicates(image_files, args.dedupe_distance, args.max_workers, fingerprints)
+        image_files = [cluster[0] for cluster in clusters]
+        duplicates = {cluster[0]: [os.path.basename(f) for f in cluster[1:]] for cluster in clusters if len(cluster) > 1}
+        metrics.increment('images.duplicates', sum(len(files) for files in duplicates.values()))
+
+    if not args.no_barcodes and not barcode_reader.available():
+        logger.info("No barcode decoder installed (zxing-cpp, or pyzbar/pylibdmtx); every photo goes to the vision model")
+
+    limiter = limiter or TokenBucket(args.requests_per_minute, burst=args.max_workers)
+    cache = None if args.no_cache else DiskCache(os.path.join(cache_dir, 'vision'),
+                                                  max_bytes=args.cache_max_mb * 1024 * 1024)
+    options = PreprocessOptions(
+        max_edge=args.max_edge,
+        image_format=args.image_format,
+        quality=args.image_quality,
+        grayscale=args.grayscale,
+        normalize_contrast=args.normalize_contrast
+    )
+
+    previous = {}
+    if args.incremental:
+        previous.update(manifest.load(catalog.key))
+    if args.resume:
+        previous.update(journal.load())
+    else:
+        journal.reset()
+
+    output_path = resolve_output_path(args.output)
+    writer = InventoryWriter(output_path, args.location, image_files)
+    try:
+        with metrics.timer('process_images'):
+            state = process_images(image_files, catalog, client, args, limiter, cache, options,
+                                   journal=journal, writer=writer, previous=previous, metrics=metrics,
+                                   executor=executor)
+    finally:
+        writer.close()
+        metrics.increment('rows_written', writer.row_count)
+        try:
+            metrics.write(metrics_path(output_path))
+        except OSError as e:
+            logger.warning(f"Could not write run metrics: {str(e)}")
+
+    if not writer.row_count:
+        os.remove(output_path)
+        raise EquipmentProcessorError("No valid data extracted from images")
+
+    for image_file, duplicate_files in duplicates.items():
+        state[image_file]['duplicate_files'] = duplicate_files
+
+    # Record what this inventory was built from, then there is nothing left to resume
+    manifest.save(catalog.key, {os.path.basename(image_file): entry for image_file, entry in state.items()},
+                  image_files, fingerprints)
+    journal.reset()
+    logger.info(f"Results saved to: {output_path}")
+    return output_path
+
+def resolve_locations(uploads_root, patterns):
+    """Location names for --locations, expanding glob patterns against the photo folders"""
+    photo_root = os.path.join(uploads_root, 'photos')
+    available = sorted(d for d in os.listdir(photo_root) if os.path.isdir(os.path.join(photo_root, d))) \
+        if os.path.isdir(photo_root) else []
+    locations = []
+    for pattern in patterns:
+        matches = [d for d in available if fnmatch(d, pattern)] if has_magic(pattern) else [pattern]
+        if not matches:
+            logger.warning(f"No photo folders match location pattern: {pattern}")
+        locations.extend(location for location in matches if location not in locations)
+    if not locations:
+        raise EquipmentProcessorError(f"No locations found for {' '.join(patterns)} in {photo_root}")
+    return locations
+
+def run_batch(args, client=None, limiter=None):
+    """Process several locations and return {location: inventory CSV path}.
+
+    All locations share one OpenAI client, rate limiter and extraction pool
+    of args.max_workers threads, and identical manufacturer files are loaded
+    once. Up to args.concurrent_locations locations run at a time, so one
+    location's matching overlaps with others' extraction. A failed location
+    is logged and the rest still run; the error is raised at the end.
+    """
+    locations = resolve_locations(args.uploads_root, args.locations)
+    output_dir = os.path.dirname(args.output) if args.output.lower().endswith('.csv') else args.output
+    os.makedirs(output_dir, exist_ok=True)
+    client = client or configure_openai()
+    limiter = limiter or TokenBucket(args.requests_per_minute, burst=args.max_workers)
+    logger.info(f"Batch processing {len(locations)} locations: {', '.join(locations)}")
+
+    def run_location(location):
+        location_args = argparse.Namespace(**{
+            **vars(args),
+            'location': location,
+            'locations': None,
+            'output': os.path.join(output_dir, f"equipment_inventory_{location}.csv")
+        })
+        return run(location_args, client, limiter, executor=executor)
+
+    outputs, failures = {}, {}
+    with ThreadPoolExecutor(max_workers=args.max_workers) as executor, \
+            ThreadPoolExecutor(max_workers=args.concurrent_locations) as location_executor:
+        futures = {location_executor.submit(run_location, location): location for location in locations}
+        for future in as_completed(futures):
+            location = futures[future]
+            try:
+                outputs[location] = future.result()
+                logger.info(f"Location {location} done: {outputs[location]}")
+            except Exception as e:
+                failures[location] = str(e)
+                logger.error(f"Location {location} failed: {str(e)}")
+
+    logger.info(f"Batch finished: {len(outputs)} of {len(locations)} locations succeeded")
+    if failures:
+        raise EquipmentProcessorError(
+            "Failed locations: " + '; '.join(f"{location} ({error})" for location, error in failures.items()))
+    return {location: outputs[location] for location in locations}
+
 def main():
     try:
         logger.info("=" * 60)
         logger.info(f"Starting equipment processing at {datetime.now()}")
         logger.info("=" * 60)
 
-        parser = argparse.ArgumentParser()
-        parser.add_argument('--location', required=True)
-        parser.add_argument('--output', required=True)
-        parser.add_argument('--uploads_root', required=True)
-        args = parser.parse_args()
-
-        client = configure_openai()
-
-        photo_dir = os.path.join(args.uploads_root, 'photos', args.location)
-        image_files = glob(os.path.join(photo_dir, '*.jpg')) + \
-                      glob(os.path.join(photo_dir, '*.jpeg')) + \
-                      glob(os.path.join(photo_dir, '*.png'))
-
-        if not image_files:
-            raise EquipmentProcessorError(f"No images found in {photo_dir}")
-
-        results = []
-        for image_file in image_files:
-            response = extract_from_image(image_file, client)
-            if response:
-                cleaned = clean_json_response(response)
-                if cleaned:
-                    try:
-                        data = json.loads(cleaned)
-                        if isinstance(data, dict):
-                            data['image_file'] = image_file
-                            results.append(data)
-                        elif isinstance(data, list):
-                            for item in data:
-                                item['image_file'] = image_file
-                                results.append(item)
-                    except json.JSONDecodeError as e:
-                        logger.error(f"JSON decode error in {image_file}: {e}")
-
-        if not results:
-            raise EquipmentProcessorError("No valid data extracted from images")
-
-        df_extracted = pd.DataFrame(results)
-        manufacturer_dir = os.path.join(args.uploads_root, 'manufacturer', args.location)
-        manufacturer_files = glob(os.path.join(manufacturer_dir, '*.xlsx')) + glob(os.path.join(manufacturer_dir, '*.xls'))
-
-        if not manufacturer_files:
-            raise EquipmentProcessorError(f"No manufacturer files found in {manufacturer_dir}")
-
-        df_manufacturers = load_manufacturer_data(manufacturer_files[0])
-
-        # Normalize values
-        df_extracted['part_number'] = df_extracted['part_number'].astype(str).str.upper().str.strip()
-        df_manufacturers['Manufacturer Part Number'] = df_manufacturers['Manufacturer Part Number'].astype(str).str.upper().str.strip()
-
-        matched_data = []
-        for _, row in df_extracted.iterrows():
-            matched = row.copy()
-
-            # Stage 1: Exact part number match
-            exact = df_manufacturers[df_manufacturers['Manufacturer Part Number'] == row['part_number']]
-            if not exact.empty:
-                matched['item_number'] = exact.iloc[0]['Item Number']
-                matched['match_method'] = 'exact_part_number'
-                matched_data.append(matched)
-                continue
-
-            # Stage 2: Try to find in description without API call
-            if pd.notna(row.get('description')):
-                # First try exact matches in manufacturer descriptions
-                for _, mfr_row in df_manufacturers.iterrows():
-                    if pd.notna(mfr_row['Item Description']) and str(mfr_row['Item Description']).lower() in row['description'].lower():
-                        matched['item_number'] = mfr_row['Item Number']
-                        matched['match_method'] = 'exact_description_match'
-                        matched_data.append(matched)
-                        break
-                else:
-                    # Only use API if no matches found
-                    ai_match = ai_description_matcher(row['description'], df_manufacturers, client)
-                    if ai_match and ai_match in df_manufacturers['Item Number'].values:
-                        matched['item_number'] = ai_match
-                        matched['match_method'] = 'ai_description_match'
-                        matched_data.append(matched)
-                        continue
-
-            # Stage 3: Fuzzy match on part number
-            close_matches = get_close_matches(
-                row['part_number'],
-                df_manufacturers['Manufacturer Part Number'].unique(),
-                n=1,
-                cutoff=0.7
-            )
-            if close_matches:
-                matched['item_number'] = df_manufacturers[
-                    df_manufacturers['Manufacturer Part Number'] == close_matches[0]
-                ].iloc[0]['Item Number']
-                matched['match_method'] = 'fuzzy_part_number'
-            else:
-                matched['item_number'] = None
-                matched['match_method'] = 'no_match'
-
-            matched_data.append(matched)
-
-        df_final = pd.DataFrame(matched_data)
-        df_final['From location'] = args.location
-
-        # Prepare output
-        output_columns = {
-            'asset_tag': 'Asset Tag #',
-            'serial_number': 'Serial Number',
-            'item_number': 'Item Number',
-            'part_number': 'Mfr Part number',
-            'From location': 'From location',
-            'quantity': 'Quantity',
-            'quality': 'Quality',
-            'werf': 'WERF#',
-            'wrt': 'WRT#',
-            'toe_tag': 'Toe Tag #'
-        }
-
-        df_output = df_final[[k for k in output_columns if k in df_final.columns]]
-        df_output = df_output.rename(columns=output_columns)
-        df_output['Quantity'] = 1
-        df_output['Quality'] = 'Good'
-        df_output['WERF#'] = ' '
-        df_output['WRT#'] = ' '
-        df_output['Toe Tag #'] = ' '
-        save_results(df_output, args.output)
+        args = build_arg_parser().parse_args()
+        if args.locations:
+            run_batch(args)
+        else:
+            run(args)
 
     except EquipmentProcessorError as e:
         logger.error(f"Equipment Processor Error: {str(e)}")
@@ -356,4 +979,4 @@ def main():
         traceback.print_exc()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,50 +1,52 @@
 import os
-import re
-import openai
 from openai import OpenAI
-import pandas as pd
 from datetime import datetime
 from PyPDF2 import PdfReader
 import pytz
 from dotenv import load_dotenv
 import argparse
 import json
-import xlwings as xw
+import multiprocessing
+import shutil
+import subprocess
+import tempfile
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import openpyxl
+from openpyxl.utils.cell import coordinate_to_tuple
+from disk_cache import DiskCache, content_key, file_sha256
+from rate_limiter import TokenBucket, call_with_backoff
+from jha_fields import PARSER_VERSION, extract_sections, parse_jha_fields
+from run_metrics import NO_METRICS, RunMetrics, metrics_path
 
-# Parse command-line arguments
-parser = argparse.ArgumentParser(description="Process JHA PDF files.")
-parser.add_argument('--uploads_root', required=True, help='Root uploads directory')
-parser.add_argument('--location', required=True, help='Location identifier')
-args = parser.parse_args()
+try:
+    import tiktoken
+except ImportError:  # Token counts fall back to an estimate
+    tiktoken = None
+
+try:
+    import xlwings as xw
+except ImportError:  # Only needed for --excel_backend xlwings, which requires Excel
+    xw = None
+
+try:
+    from pyxlsb import open_workbook as open_xlsb
+except ImportError:
+    open_xlsb = None
 
 # Load environment variables
 load_dotenv()
 
-# Configure OpenAI
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
 # Constants
-UPLOADS_ROOT = args.uploads_root
-LOCATION = args.location
-PDF_DIR = os.path.join(UPLOADS_ROOT, 'jha', LOCATION, 'pdfs')
-EXCEL_TEMPLATE = os.path.join(UPLOADS_ROOT, 'jha', LOCATION, 'excel')
-OUTPUT_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'output', 'jha', LOCATION)
-os.makedirs(OUTPUT_DIR, exist_ok=True)  # Ensure the directory exists
-OUTPUT_EXCEL = os.path.join(OUTPUT_DIR, "jha_processed.xlsx")
+OUTPUT_ROOT = os.path.join(os.path.dirname(__file__), '..', '..', 'output', 'jha')
 TIMEZONE = pytz.timezone('America/New_York')
-
-def extract_text_from_pdf(pdf_path):
-    """Extract text from PDF file"""
-    with open(pdf_path, 'rb') as file:
-        reader = PdfReader(file)
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text()
-    return text
-
-def parse_pdf_with_ai(pdf_text):
-    """Use AI to extract structured data from PDF text"""
-    prompt = f"""
+JHA_MODEL = "o4-mini"
+MAX_PROMPT_TOKENS = 3000  # Budget for the document text in one prompt
+PDF_POOL_MIN = 3  # Fewer PDFs than this are read in-process; spawning workers costs more
+CHARS_PER_TOKEN = 4  # Estimate used when tiktoken is not installed
+EXCEL_BACKENDS = ('openpyxl', 'xlwings')
+TEMPLATE_EXTENSIONS = ('.xlsx', '.xlsm', '.xlsb')  # In order of preference
+JHA_PROMPT = """
     Extract the following information from this JHA document:
     
     1. Under "JOB SITE WORK/HAZARD IDENTIFICATION AND CONTROLS":
@@ -62,9 +64,75 @@ def parse_pdf_with_ai(pdf_text):
     Document text:
     {pdf_text}
     """
+
+def configure_openai():
+    """Create the OpenAI client used for JHA parsing"""
+    # Retries are handled by call_with_backoff so they go through the rate limiter
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+def location_paths(uploads_root, location):
+    """Input and output locations for one JHA location"""
+    output_dir = os.path.join(OUTPUT_ROOT, location)
+    return {
+        'pdf_dir': os.path.join(uploads_root, 'jha', location, 'pdfs'),
+        'excel_template': os.path.join(uploads_root, 'jha', location, 'excel'),
+        'output_dir': output_dir,
+        'output_excel': os.path.join(output_dir, "jha_processed.xlsx")
+    }
+
+def read_pdf(pdf_path):
+    """Extract text and filled-in form field values from a PDF"""
+    with open(pdf_path, 'rb') as file:
+        reader = PdfReader(file)
+        text = "\n".join(page.extract_text() or "" for page in reader.pages)
+        fields = reader.get_fields() or {}
+    form_fields = {name: field.get('/V') for name, field in fields.items() if field.get('/V') is not None}
+    return text, form_fields
+
+@lru_cache(maxsize=None)
+def _encoding():
+    try:
+        return tiktoken.encoding_for_model(JHA_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+def count_tokens(text):
+    """Number of model tokens in text (estimated if tiktoken is not installed)"""
+    if tiktoken is None:
+        return -(-len(text) // CHARS_PER_TOKEN)
+    return len(_encoding().encode(text))
+
+def truncate_to_tokens(text, max_tokens):
+    """Cut text down to at most max_tokens tokens"""
+    if tiktoken is None:
+        return text[:max_tokens * CHARS_PER_TOKEN]
+    tokens = _encoding().encode(text)
+    return text if len(tokens) <= max_tokens else _encoding().decode(tokens[:max_tokens])
+
+def prompt_text(pdf_name, text, max_tokens=MAX_PROMPT_TOKENS, metrics=NO_METRICS):
+    """The part of a PDF's text sent to the model: its JHA sections, within the token budget"""
+    sections = extract_sections(text)
+    full_tokens = count_tokens(text)
+    section_tokens = count_tokens(sections)
+    if section_tokens > max_tokens:
+        sections = truncate_to_tokens(sections, max_tokens)
+        metrics.increment('pdfs.truncated')
+        print(f"Warning: {pdf_name} sections truncated from {section_tokens} to {max_tokens} tokens")
+    print(f"{pdf_name}: {full_tokens} tokens in document, {min(section_tokens, max_tokens)} sent")
+    metrics.increment('document_tokens', full_tokens)
+    metrics.increment('document_tokens.sent', min(section_tokens, max_tokens))
+    return sections
+
+def parse_pdf_with_ai(pdf_text, client, limiter=None, metrics=NO_METRICS):
+    """Use AI to extract structured data from PDF text"""
+    prompt = JHA_PROMPT.format(pdf_text=pdf_text)
     
-    response = client.chat.completions.create(
-        model="o4-mini",
+    response = call_with_backoff(
+        client.chat.completions.create,
+        limiter=limiter,
+        metrics=metrics,
+        label='jha_parse',
+        model=JHA_MODEL,
         messages=[
             {"role": "system", "content": "You are a JHA document parser. Extract structured data."},
             {"role": "user", "content": prompt}
@@ -74,21 +142,114 @@ def parse_pdf_with_ai(pdf_text):
     
     return json.loads(response.choices[0].message.content)
 
-def process_pdf_files():
-    """Process all PDF files in date-time order"""
+def process_pdf_files(pdf_dir, client, cache=None, limiter=None, max_workers=4, min_confidence=0.8,
+                      max_prompt_tokens=MAX_PROMPT_TOKENS, metrics=NO_METRICS):
+    """Process all PDF files in date-time order.
+
+    Text extraction is CPU-bound and runs in a process pool. Fields are
+    first parsed locally from the standard template; only PDFs parsed with
+    less than min_confidence go to the model, concurrently on a thread pool
+    under the shared rate limiter, with only their JHA sections in the
+    prompt. Model results are cached by PDF content and token budget as
+    each one arrives, and local results by PDF content and parser version
+    along with their confidence, so re-runs only read and pay for new PDFs,
+    even when this run fails. PDFs that cannot be read or parsed are
+    reported together once every other PDF is done.
+    """
     pdf_files = sorted(
-        [f for f in os.listdir(PDF_DIR) if f.endswith('.pdf')],
+        [f for f in os.listdir(pdf_dir) if f.endswith('.pdf')],
         key=lambda x: datetime.strptime(x.split('.')[0], '%Y-%m-%d %H-%M-%S')
     )
-    
+    pdf_paths = [os.path.join(pdf_dir, pdf_file) for pdf_file in pdf_files]
+
+    parsed = {}
+    cache_keys = {}
+    local_keys = {}
+    if cache is not None:
+        for pdf_path in pdf_paths:
+            pdf_hash = file_sha256(pdf_path)
+            cache_keys[pdf_path] = content_key(JHA_MODEL, JHA_PROMPT, str(max_prompt_tokens), pdf_hash)
+            local_keys[pdf_path] = content_key('parse_jha_fields', str(PARSER_VERSION), pdf_hash)
+            cached = cache.get(cache_keys[pdf_path])
+            if cached is None:
+                # Local parses are reused only while they still clear min_confidence
+                local = cache.get(local_keys[pdf_path])
+                if local is not None and local['confidence'] >= min_confidence:
+                    cached = local['data']
+            if cached is not None:
+                parsed[pdf_path] = cached
+    to_parse = [pdf_path for pdf_path in pdf_paths if pdf_path not in parsed]
+    print(f"{len(parsed)} PDFs cached, {len(to_parse)} to parse")
+    metrics.increment('pdfs.total', len(pdf_paths))
+    if cache is not None:
+        metrics.increment('jha_cache.hits', len(parsed))
+        metrics.increment('jha_cache.misses', len(to_parse))
+
+    failed = {}
+    if to_parse:
+        documents = {}
+        with metrics.timer('pdf_read'):
+            if len(to_parse) < PDF_POOL_MIN or max_workers <= 1:
+                for pdf_path in to_parse:
+                    try:
+                        documents[pdf_path] = read_pdf(pdf_path)
+                    except Exception as e:
+                        failed[pdf_path] = e
+            else:
+                # Spawned, not forked: worker.py calls this from a multithreaded process
+                with ProcessPoolExecutor(max_workers=min(max_workers, len(to_parse)),
+                                         mp_context=multiprocessing.get_context('spawn')) as executor:
+                    futures = {executor.submit(read_pdf, pdf_path): pdf_path for pdf_path in to_parse}
+                    for future in as_completed(futures):
+                        try:
+                            documents[futures[future]] = future.result()
+                        except Exception as e:
+                            failed[futures[future]] = e
+
+        needs_ai = []
+        with metrics.timer('local_parse'):
+            for pdf_path in to_parse:
+                if pdf_path not in documents:
+                    continue
+                text, form_fields = documents[pdf_path]
+                data, confidence = parse_jha_fields(text, form_fields)
+                if confidence >= min_confidence:
+                    parsed[pdf_path] = data
+                    if cache is not None:
+                        cache.set(local_keys[pdf_path], {'data': data, 'confidence': confidence})
+                else:
+                    print(f"Low confidence ({confidence:.2f}) parsing {os.path.basename(pdf_path)} locally, using AI")
+                    needs_ai.append((pdf_path, prompt_text(os.path.basename(pdf_path), text, max_prompt_tokens,
+                                                           metrics)))
+        parsed_locally = len(documents) - len(needs_ai)
+        print(f"{parsed_locally} PDFs parsed locally, {len(needs_ai)} sent to AI")
+        metrics.increment('pdfs.parsed_locally', parsed_locally)
+        metrics.increment('pdfs.sent_to_ai', len(needs_ai))
+
+        with metrics.timer('ai_parse'):
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(parse_pdf_with_ai, text, client, limiter, metrics): pdf_path
+                           for pdf_path, text in needs_ai}
+                for future in as_completed(futures):
+                    pdf_path = futures[future]
+                    try:
+                        parsed[pdf_path] = future.result()
+                    except Exception as e:
+                        failed[pdf_path] = e
+                        continue
+                    if cache is not None:
+                        cache.set(cache_keys[pdf_path], parsed[pdf_path])
+
+    if failed:
+        metrics.increment('pdfs.failed', len(failed))
+        details = '; '.join(f"{os.path.basename(pdf_path)}: {error}" for pdf_path, error in failed.items())
+        raise RuntimeError(f"Failed to process {len(failed)} of {len(pdf_paths)} PDFs ({details})")
+
     results = []
-    for pdf_file in pdf_files:
+    for pdf_file, pdf_path in zip(pdf_files, pdf_paths):
         date_str = pdf_file.split('.')[0]
         date = datetime.strptime(date_str, '%Y-%m-%d %H-%M-%S')
-        
-        pdf_path = os.path.join(PDF_DIR, pdf_file)
-        pdf_text = extract_text_from_pdf(pdf_path)
-        data = parse_pdf_with_ai(pdf_text)
+        data = parsed[pdf_path]
         
         results.append({
             'date': date,
@@ -100,61 +261,169 @@ def process_pdf_files():
     
     return sorted(results, key=lambda x: x['date'])
 
-def update_excel_file(jha_data):
-    excel_dir = EXCEL_TEMPLATE
-    excel_file = None
+def find_excel_template(excel_dir):
+    """The location's Excel template, preferring formats openpyxl can load directly"""
+    templates = [f for f in os.listdir(excel_dir) if not f.startswith("~$")]
+    for extension in TEMPLATE_EXTENSIONS:
+        for file in sorted(templates):
+            if file.lower().endswith(extension):
+                return os.path.join(excel_dir, file)
+    raise FileNotFoundError(f"No Excel ({', '.join(TEMPLATE_EXTENSIONS)}) file found in directory: {excel_dir}")
 
-    for file in os.listdir(excel_dir):
-        if file.endswith(".xlsb") and not file.startswith("~$"):
-            excel_file = os.path.join(excel_dir, file)
-            break
+def sheet_updates(jha_data):
+    """Values to write per "Day N" sheet, as (top-left cell, 2D rows) blocks"""
+    updates = {}
+    for day, data in enumerate(jha_data, start=1):
+        # Cell positions follow the template layout
+        updates[f"Day {day}"] = [
+            ('B1', [[data['date_str']], ['YES' if data['working_at_heights'] else 'NO'], [data['total_persons']]]),
+            ('A5', [[person['name'], person.get('nwsa_number', 'N/A')] for person in data['persons']])
+        ]
+    return updates
 
-    if not excel_file:
-        raise FileNotFoundError(f"No Excel (.xlsb) file found in directory: {excel_dir}")
+def _convert_to_xlsx(template_path, out_dir):
+    """Convert a workbook with LibreOffice and return the .xlsx path, or None if it is not installed"""
+    soffice = shutil.which('soffice') or shutil.which('libreoffice')
+    if not soffice:
+        return None
+    subprocess.run([soffice, '--headless', '--convert-to', 'xlsx', '--outdir', out_dir, template_path],
+                   check=True, capture_output=True, timeout=300)
+    return os.path.join(out_dir, os.path.splitext(os.path.basename(template_path))[0] + '.xlsx')
 
-    # Open workbook with xlwings (preserves xlsb format and macros)
-    app = xw.App(visible=False)
-    wb = app.books.open(excel_file)
+def _xlsb_values(template_path):
+    """Cell values of an .xlsb workbook copied into a new openpyxl workbook (formatting is lost)"""
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    with open_xlsb(template_path) as xlsb:
+        for name in xlsb.sheets:
+            sheet = wb.create_sheet(name)
+            with xlsb.get_sheet(name) as source:
+                for row in source.rows(sparse=True):
+                    for cell in row:
+                        if cell.v is not None:
+                            sheet.cell(row=cell.r + 1, column=cell.c + 1, value=cell.v)
+    return wb
+
+def _load_template(template_path):
+    """Load the template with openpyxl, converting .xlsb files first"""
+    if not template_path.lower().endswith('.xlsb'):
+        return openpyxl.load_workbook(template_path)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        converted = _convert_to_xlsx(template_path, tmp_dir)
+        if converted:
+            return openpyxl.load_workbook(converted)
+    if open_xlsb is None:
+        raise RuntimeError(f"Cannot open {template_path}: install LibreOffice or pyxlsb, "
+                           f"or upload the template as .xlsx")
+    print("Warning: LibreOffice not found, copying template values only (formatting is not kept)")
+    return _xlsb_values(template_path)
 
+def _write_openpyxl(updates, template_path, output_path):
+    wb = _load_template(template_path)
+    for sheet_name, blocks in updates.items():
+        if sheet_name not in wb.sheetnames:
+            print(f"Warning: Sheet '{sheet_name}' not found. Skipping.")
+            continue
+        sheet = wb[sheet_name]
+        for top_left, rows in blocks:
+            start_row, start_col = coordinate_to_tuple(top_left)
+            for r, values in enumerate(rows):
+                for c, value in enumerate(values):
+                    sheet.cell(row=start_row + r, column=start_col + c, value=value)
+    wb.save(output_path)
+
+def _write_xlwings(updates, template_path, output_path):
+    if xw is None:
+        raise RuntimeError("The xlwings backend needs xlwings and a local Excel installation")
+    # Open workbook with xlwings (preserves formatting and macros)
+    app = xw.App(visible=False)
+    wb = app.books.open(template_path)
     try:
-        for day, data in enumerate(jha_data, start=1):
-            sheet_name = f"Day {day}"
-            try:
-                sheet = wb.sheets[sheet_name]
-            except Exception as e:
+        sheet_names = [sheet.name for sheet in wb.sheets]
+        for sheet_name, blocks in updates.items():
+            if sheet_name not in sheet_names:
                 print(f"Warning: Sheet '{sheet_name}' not found. Skipping.")
                 continue
+            sheet = wb.sheets[sheet_name]
+            for top_left, rows in blocks:
+                if rows:
+                    # One range assignment per block instead of one call per cell
+                    sheet.range(top_left).value = rows
+        wb.save(output_path)
+    finally:
+        wb.close()
+        app.quit()
 
-            # Update values (adjust cell positions based on your actual template layout)
-            sheet.range('B1').value = data['date_str']  # Adjust cell address accordingly
-            sheet.range('B2').value = 'YES' if data['working_at_heights'] else 'NO'
-            sheet.range('B3').value = data['total_persons']
+def update_excel_file(jha_data, excel_dir, output_path, backend='openpyxl'):
+    """Fill the location's template with the JHA data and save it to output_path.
 
-            # Start inserting person data at row 5
-            start_row = 5
-            for i, person in enumerate(data['persons']):
-                sheet.range(f'A{start_row + i}').value = person['name']
-                sheet.range(f'B{start_row + i}').value = person.get('nwsa_number', 'N/A')
+    The default openpyxl backend runs headless (on Linux too) and loads the
+    template once. The xlwings backend drives a local Excel instance and
+    keeps .xlsb formatting and macros intact.
+    """
+    template_path = find_excel_template(excel_dir)
+    updates = sheet_updates(jha_data)
+    writers = {'openpyxl': _write_openpyxl, 'xlwings': _write_xlwings}
+    writers[backend](updates, template_path, output_path)
+    print(f"Updated Excel file saved to: {output_path}")
 
-        # Save back to same .xlsb file
-        wb.save()
-        print(f"Updated Excel file saved to: {excel_file}")
+def run(uploads_root, location, client=None, limiter=None, max_workers=4, use_cache=True, min_confidence=0.8,
+        max_prompt_tokens=MAX_PROMPT_TOKENS, excel_backend='openpyxl', metrics=None, output_path=None):
+    """Process one location's JHA PDFs into its Excel template and return the output path.
+
+    A long-running caller (see worker.py) passes its own client and limiter
+    so they are shared between runs, and its own output_path so jobs don't
+    share the location's output file. The run's metrics summary is written
+    next to the workbook as <name>.metrics.json.
+    """
+    metrics = metrics or RunMetrics('jha', location)
+    client = client or configure_openai()
+    limiter = limiter or TokenBucket(float(os.getenv('OPENAI_REQUESTS_PER_MINUTE', 60)), burst=max_workers)
+    cache = DiskCache(os.path.join(uploads_root, '.cache', 'jha')) if use_cache else None
+    paths = location_paths(uploads_root, location)
+    output_path = output_path or paths['output_excel']
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)  # Ensure the directory exists
+
+    try:
+        # Step 1: Process all PDF files
+        print("Processing PDF files...")
+        jha_data = process_pdf_files(paths['pdf_dir'], client, cache, limiter, max_workers, min_confidence,
+                                     max_prompt_tokens, metrics)
+
+        # Step 2: Update Excel template
+        print("Updating Excel file...")
+        with metrics.timer('excel_write'):
+            update_excel_file(jha_data, paths['excel_template'], output_path, excel_backend)
     finally:
-        wb.close()
-        app.quit()
+        try:
+            metrics.write(metrics_path(output_path))
+        except OSError as e:
+            print(f"Warning: could not write run metrics: {str(e)}")
+
+    print(f"Processing complete! Output saved to {output_path}")
+    return output_path
 
 def main():
+    # Parse command-line arguments
+    parser = argparse.ArgumentParser(description="Process JHA PDF files.")
+    parser.add_argument('--uploads_root', required=True, help='Root uploads directory')
+    parser.add_argument('--location', required=True, help='Location identifier')
+    parser.add_argument('--max_workers', type=int, default=int(os.getenv('EXTRACTION_WORKERS', 4)),
+                        help='PDFs parsed concurrently')
+    parser.add_argument('--no_cache', action='store_true', help='Re-parse every PDF with the model')
+    parser.add_argument('--min_confidence', type=float, default=0.8,
+                        help='Local parses below this confidence fall back to the model (above 1 always uses it)')
+    parser.add_argument('--max_prompt_tokens', type=int,
+                        default=int(os.getenv('JHA_MAX_PROMPT_TOKENS', MAX_PROMPT_TOKENS)),
+                        help='Token budget for the document text sent to the model')
+    parser.add_argument('--excel_backend', choices=EXCEL_BACKENDS,
+                        default=os.getenv('JHA_EXCEL_BACKEND', 'openpyxl'),
+                        help='Workbook writer: openpyxl (headless) or xlwings (needs Excel)')
+    args = parser.parse_args()
+
     print("Starting JHA processing...")
-    
-    # Step 1: Process all PDF files
-    print("Processing PDF files...")
-    jha_data = process_pdf_files()
-    
-    # Step 2: Update Excel template
-    print("Updating Excel file...")
-    update_excel_file(jha_data)
-    
-    print(f"Processing complete! Output saved to {OUTPUT_EXCEL}")
+    run(args.uploads_root, args.location, max_workers=args.max_workers, use_cache=not args.no_cache,
+        min_confidence=args.min_confidence, max_prompt_tokens=args.max_prompt_tokens, excel_backend=args.excel_backend)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,95 @@
+import logging
+import random
+import threading
+import time
+import openai
+from run_metrics import NO_METRICS
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Thread-safe token bucket that limits how many API requests start per minute"""
+
+    def __init__(self, requests_per_minute, burst=None):
+        if requests_per_minute <= 0:
+            raise ValueError("requests_per_minute must be positive")
+        self.rate = requests_per_minute / 60.0
+        self.capacity = float(burst or 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request slot is available"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def _retry_after(error):
+    """Seconds the API asked us to wait, if it sent a Retry-After header"""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _retryable(error):
+    """Whether an API error is transient: the ones the SDK itself would retry"""
+    if isinstance(error, openai.RateLimitError):
+        # An exhausted quota will not recover by waiting
+        return getattr(error, 'code', None) != 'insufficient_quota'
+    if isinstance(error, openai.APIConnectionError):
+        # Dropped connections and timeouts (APITimeoutError is a subclass)
+        return True
+    return isinstance(error, openai.APIStatusError) and (error.status_code in (408, 409) or error.status_code >= 500)
+
+
+def call_with_backoff(func, *args, limiter=None, max_retries=5, base_delay=1.0, max_delay=60.0,
+                      metrics=NO_METRICS, label='api', **kwargs):
+    """Call an OpenAI endpoint, retrying transient errors with exponential backoff.
+
+    429s, connection errors, timeouts, 408/409 and 5xx responses are retried;
+    clients are created with max_retries=0 so this is the only retry loop.
+
+    Every attempt (including retries) takes a token from `limiter` first, so
+    retries count against the same request budget as fresh calls. The call's
+    latency, attempts, waiting time and token usage are recorded in `metrics`
+    under `label`.
+    """
+    waited = 0.0
+    for attempt in range(max_retries + 1):
+        if limiter is not None:
+            wait_start = time.perf_counter()
+            limiter.acquire()
+            waited += time.perf_counter() - wait_start
+        start = time.perf_counter()
+        try:
+            response = func(*args, **kwargs)
+        except Exception as e:
+            if not _retryable(e) or attempt == max_retries:
+                metrics.record_call(label, time.perf_counter() - start, attempt + 1, waited, failed=True)
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = min(max_delay, base_delay * (2 ** attempt))
+                delay = random.uniform(delay / 2, delay)
+            reason = 'Rate limited' if isinstance(e, openai.RateLimitError) else f"{type(e).__name__}: {e}"
+            logger.warning(f"{reason} (attempt {attempt + 1}/{max_retries + 1}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            waited += delay
+        else:
+            metrics.record_call(label, time.perf_counter() - start, attempt + 1, waited,
+                                usage=getattr(response, 'usage', None))
+            return response
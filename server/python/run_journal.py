@@ -0,0 +1,161 @@
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def to_jsonable(value):
+    """Convert numpy/pandas scalars and NaN into plain JSON values"""
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
+
+
+class RunJournal:
+    """Append-only JSON-lines log of per-image progress for one location's run.
+
+    Each image gets an "extracted" record as soon as its (paid-for) vision
+    extraction completes and a "matched" record once its rows are final, so
+    an interrupted run can be resumed without repeating either step.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def load(self):
+        """Latest state per image name: {'sha256', 'items'} plus 'rows' once matched"""
+        state = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A run killed mid-write leaves a truncated last line
+                        continue
+                    entry = state.setdefault(record['image'], {})
+                    if record.get('sha256') != entry.get('sha256'):
+                        entry.clear()
+                    entry.update({k: v for k, v in record.items() if k not in ('image', 'type')})
+        except FileNotFoundError:
+            pass
+        logger.info(f"Loaded run journal {self.path} with {len(state)} images")
+        return state
+
+    def _append(self, record):
+        line = json.dumps(record, default=str)
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def record_extraction(self, image, sha256, items):
+        self._append({'type': 'extracted', 'image': image, 'sha256': sha256, 'items': items})
+
+    def record_match(self, image, sha256, rows):
+        rows = [{key: to_jsonable(value) for key, value in dict(row).items()} for row in rows]
+        self._append({'type': 'matched', 'image': image, 'sha256': sha256, 'rows': rows})
+
+    def reset(self):
+        """Forget all progress, e.g. after a run completes"""
+        with self._lock:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class RunManifest:
+    """Per-location record of the images behind the last completed inventory.
+
+    Stores each image's content hash, size, mtime, extracted items, matched
+    rows and the near-duplicate photos skipped in its favour, so an
+    incremental run only processes new or changed photos. Images whose
+    extraction failed are left out, so the next run extracts them again.
+    Near-duplicate fingerprints are kept for every photo in the folder, so
+    only new or changed photos are decoded to find duplicates.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def load(self, catalog_key):
+        """Image name -> recorded state, usable as process_images(previous=...).
+
+        If the manufacturer catalog changed since the manifest was written,
+        extracted items are kept but matched rows are dropped so they are
+        re-matched against the new catalog.
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        images = manifest.get('images', {})
+        if manifest.get('catalog_key') != catalog_key:
+            logger.info("Manufacturer catalog changed since the last run; re-matching recorded items")
+            for entry in images.values():
+                entry.pop('rows', None)
+        logger.info(f"Loaded manifest {self.path} with {len(images)} images")
+        return images
+
+    def load_fingerprints(self, image_files):
+        """Recorded (hash, sharpness) of each image whose size and mtime are unchanged"""
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                recorded = json.load(f).get('fingerprints', {})
+        except (OSError, ValueError):
+            return {}
+        fingerprints = {}
+        for image_file in image_files:
+            entry = recorded.get(os.path.basename(image_file))
+            if not entry:
+                continue
+            stat = os.stat(image_file)
+            if entry.get('size') == stat.st_size and entry.get('mtime_ns') == stat.st_mtime_ns:
+                fingerprints[image_file] = (int(entry['hash'], 16), entry['sharpness'])
+        return fingerprints
+
+    def save(self, catalog_key, state, image_files, fingerprints=None):
+        """Atomically replace the manifest with the state of a completed run.
+
+        `fingerprints` maps image files to their near-duplicate (hash, sharpness).
+        """
+        images = {}
+        for image_file in image_files:
+            name = os.path.basename(image_file)
+            entry = state[name]
+            if entry.get('failed'):
+                continue
+            stat = os.stat(image_file)
+            images[name] = {
+                'sha256': entry['sha256'],
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'items': entry.get('items', []),
+                'rows': [{key: to_jsonable(value) for key, value in dict(row).items()} for row in entry.get('rows', [])],
+                'duplicate_files': entry.get('duplicate_files', [])
+            }
+        recorded = {}
+        for image_file, (image_hash, sharpness) in (fingerprints or {}).items():
+            stat = os.stat(image_file)
+            recorded[os.path.basename(image_file)] = {
+                'size': stat.st_size,
+                'mtime_ns': stat.st_mtime_ns,
+                'hash': f"{image_hash:x}",
+                'sharpness': sharpness
+            }
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump({'catalog_key': catalog_key, 'images': images, 'fingerprints': recorded}, f, default=str)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+class RunMetrics:
+    """Thread-safe collector for one processing run.
+
+    Records cumulative time per stage, latency, retries and token usage per
+    API call, and named counters (cache hits, match methods, ...).
+    Stage times are summed across threads, so they can exceed wall time.
+    summary() returns everything as a JSON-serializable dict.
+    """
+
+    def __init__(self, processor, location=None):
+        self.processor = processor
+        self.location = location
+        self._started_at = datetime.now()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stages = defaultdict(lambda: {'count': 0, 'seconds': 0.0})
+        self._counters = Counter()
+        self._calls = defaultdict(list)
+
+    @contextmanager
+    def timer(self, stage):
+        """Add the time spent in the with-block to stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self._stages[stage]['count'] += 1
+            self._stages[stage]['seconds'] += seconds
+
+    def increment(self, counter, amount=1):
+        with self._lock:
+            self._counters[counter] += amount
+
+    def record_call(self, label, latency, attempts=1, wait_seconds=0.0, usage=None, failed=False):
+        """One API call: latency of its last attempt, attempts made, time spent rate limited or backing off"""
+        call = {
+            'latency': latency,
+            'attempts': attempts,
+            'wait_seconds': wait_seconds,
+            'failed': failed,
+            'prompt_tokens': getattr(usage, 'prompt_tokens', 0) or 0,
+            'completion_tokens': getattr(usage, 'completion_tokens', 0) or 0
+        }
+        with self._lock:
+            self._calls[label].append(call)
+
+    def summary(self):
+        with self._lock:
+            api_calls = {}
+            for label, calls in self._calls.items():
+                latencies = sorted(call['latency'] for call in calls)
+                api_calls[label] = {
+                    'calls': len(calls),
+                    'failed': sum(call['failed'] for call in calls),
+                    'retries': sum(call['attempts'] - 1 for call in calls),
+                    'wait_seconds': round(sum(call['wait_seconds'] for call in calls), 3),
+                    'latency_seconds': {
+                        'total': round(sum(latencies), 3),
+                        'mean': round(sum(latencies) / len(latencies), 3),
+                        'p50': round(_percentile(latencies, 0.5), 3),
+                        'p95': round(_percentile(latencies, 0.95), 3),
+                        'max': round(latencies[-1], 3)
+                    },
+                    'prompt_tokens': sum(call['prompt_tokens'] for call in calls),
+                    'completion_tokens': sum(call['completion_tokens'] for call in calls)
+                }
+            return {
+                'processor': self.processor,
+                'location': self.location,
+                'started_at': self._started_at.isoformat(),
+                'wall_seconds': round(time.perf_counter() - self._start, 3),
+                'stages': {stage: {'count': s['count'], 'seconds': round(s['seconds'], 3)}
+                           for stage, s in self._stages.items()},
+                'api_calls': api_calls,
+                'counters': dict(self._counters)
+            }
+
+    def write(self, path):
+        """Atomically write the summary as JSON and return it"""
+        summary = self.summary()
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        os.replace(tmp_path, path)
+        logger.info(f"Run metrics written to {path} ({summary['wall_seconds']}s wall time)")
+        return summary
+
+
+class NullMetrics:
+    """Stand-in for RunMetrics that discards everything, for callers not collecting metrics"""
+
+    def timer(self, stage):
+        return nullcontext()
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def increment(self, counter, amount=1):
+        pass
+
+    def record_call(self, label, latency, attempts=1, wait_seconds=0.0, usage=None, failed=False):
+        pass
+
+
+NO_METRICS = NullMetrics()
+
+
+def metrics_path(output_path):
+    """Where a run's metrics summary is written next to its output file"""
+    return os.path.splitext(output_path)[0] + '.metrics.json'
@@ -0,0 +1,146 @@
+"""Long-running worker that processes equipment and JHA jobs from a queue directory.
+
+The Node routes submit a job by creating <queue_dir>/<job_id>/job.json:
+
+    {"id": "<job_id>", "type": "equipment" | "jha", "location": "<location>", "options": ["--max_workers", "8"]}
+
+The worker claims it by renaming job.json to claimed.json, then keeps
+<queue_dir>/<job_id>/status.json up to date with "queued", "running", "done"
+or "failed". A finished job's status carries the result file path, and
+every finished or failed job's status carries the run's metrics summary. The
+OpenAI client, rate limiter and loaded catalogs live as long as the worker,
+so jobs skip interpreter start-up, imports and catalog parsing.
+"""
+import argparse
+import json
+import logging
+import os
+import tempfile
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import process_equipment
+import process_jha
+from rate_limiter import TokenBucket
+from run_metrics import RunMetrics
+
+logger = logging.getLogger(__name__)
+
+
+def write_status(job_dir, **status):
+    """Atomically replace a job's status.json"""
+    status['updated_at'] = datetime.now().isoformat()
+    fd, tmp_path = tempfile.mkstemp(dir=job_dir, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, os.path.join(job_dir, 'status.json'))
+
+
+def claim_jobs(queue_dir, limit):
+    """Claim up to limit queued jobs, oldest first, and return (job_dir, job) pairs"""
+    claimed = []
+    for job_id in sorted(os.listdir(queue_dir)):
+        if len(claimed) >= limit:
+            break
+        job_dir = os.path.join(queue_dir, job_id)
+        job_path = os.path.join(job_dir, 'job.json')
+        claimed_path = os.path.join(job_dir, 'claimed.json')
+        if not os.path.isfile(job_path):
+            continue
+        try:
+            # Only one worker can win the rename
+            os.rename(job_path, claimed_path)
+        except OSError:
+            continue
+        try:
+            with open(claimed_path, 'r', encoding='utf-8') as f:
+                claimed.append((job_dir, json.load(f)))
+        except (OSError, ValueError) as e:
+            write_status(job_dir, status='failed', error=f"Unreadable job file: {str(e)}")
+    return claimed
+
+
+class Worker:
+    """Holds the state shared between jobs and runs them"""
+
+    def __init__(self, uploads_root, requests_per_minute, max_workers):
+        self.uploads_root = uploads_root
+        self.equipment_client = process_equipment.configure_openai()
+        self.jha_client = process_jha.configure_openai()
+        self.limiter = TokenBucket(requests_per_minute, burst=max_workers)
+
+    def run_equipment(self, job, job_dir, metrics):
+        argv = [
+            '--location', job['location'],
+            '--output', os.path.join(job_dir, 'equipment_inventory.csv'),
+            '--uploads_root', self.uploads_root
+        ] + [str(option) for option in job.get('options', [])]
+        args = process_equipment.build_arg_parser().parse_args(argv)
+        return process_equipment.run(args, self.equipment_client, self.limiter, metrics)
+
+    def run_jha(self, job, job_dir, metrics):
+        return process_jha.run(self.uploads_root, job['location'], self.jha_client, self.limiter, metrics=metrics,
+                               output_path=os.path.join(job_dir, 'jha_processed.xlsx'))
+
+    def process(self, job_dir, job):
+        runners = {'equipment': self.run_equipment, 'jha': self.run_jha}
+        started_at = datetime.now().isoformat()
+        metrics = RunMetrics(job.get('type'), job.get('location'))
+        write_status(job_dir, status='running', started_at=started_at)
+        logger.info(f"Starting {job.get('type')} job {job.get('id')} for location {job.get('location')}")
+        try:
+            runner = runners.get(job.get('type'))
+            if runner is None:
+                raise ValueError(f"Unknown job type: {job.get('type')}")
+            if not job.get('location'):
+                raise ValueError("Job has no location")
+            result = runner(job, job_dir, metrics)
+            if not result or not os.path.exists(result):
+                raise FileNotFoundError("Processing completed but no result file was generated")
+            write_status(job_dir, status='done', started_at=started_at,
+                         finished_at=datetime.now().isoformat(), result=os.path.abspath(result),
+                         metrics=metrics.summary())
+            logger.info(f"Finished job {job.get('id')}: {result}")
+        except (Exception, SystemExit) as e:
+            # SystemExit from argparse on bad options must fail the job, not the worker
+            logger.error(f"Job {job.get('id')} failed: {str(e)}")
+            traceback.print_exc()
+            write_status(job_dir, status='failed', started_at=started_at,
+                         finished_at=datetime.now().isoformat(), error=str(e) or type(e).__name__,
+                         metrics=metrics.summary())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Process equipment and JHA jobs from a queue directory.")
+    parser.add_argument('--uploads_root', required=True, help='Root uploads directory')
+    parser.add_argument('--queue_dir', default=None, help='Job queue directory (default: <uploads_root>/.cache/jobs)')
+    parser.add_argument('--concurrent_jobs', type=int, default=2, help='Jobs processed at the same time')
+    parser.add_argument('--poll_interval', type=float, default=1.0, help='Seconds between queue scans')
+    parser.add_argument('--max_workers', type=int, default=int(os.getenv('EXTRACTION_WORKERS', 4)),
+                        help='Burst size of the shared rate limiter')
+    parser.add_argument('--requests_per_minute', type=float, default=float(os.getenv('OPENAI_REQUESTS_PER_MINUTE', 60)),
+                        help='Upper bound on OpenAI requests started per minute, shared by all jobs')
+    args = parser.parse_args()
+
+    queue_dir = args.queue_dir or os.path.join(args.uploads_root, '.cache', 'jobs')
+    os.makedirs(queue_dir, exist_ok=True)
+    worker = Worker(args.uploads_root, args.requests_per_minute, args.max_workers)
+    logger.info(f"Worker watching {queue_dir}")
+
+    with ThreadPoolExecutor(max_workers=args.concurrent_jobs) as executor:
+        running = set()
+        try:
+            while True:
+                running = {future for future in running if not future.done()}
+                if len(running) < args.concurrent_jobs:
+                    for job_dir, job in claim_jobs(queue_dir, args.concurrent_jobs - len(running)):
+                        running.add(executor.submit(worker.process, job_dir, job))
+                time.sleep(args.poll_interval)
+        except KeyboardInterrupt:
+            logger.info("Worker stopping after running jobs finish")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ const fs = require('fs');
 const path = require('path');
 const util = require('util');
 const { exec } = require('child_process');
+const { submitJob, getJobStatus } = require('../jobQueue');
+const { readRunMetrics, setMetricsHeader } = require('../runMetrics');
 
 const router = express.Router();
 const execPromise = util.promisify(exec);
@@ -23,65 +25,72 @@ const logError = (error, context = {}) => {
     fs.appendFileSync('server_errors.log', JSON.stringify(logEntry) + '\n');
 };
 
-router.post('/:location', async (req, res) => {
-    const { location } = req.params;
-    const requestId = Date.now();
+// Validate a location's JHA uploads and return its paths
+const validateLocation = location => {
+    if (!location) {
+        const error = new Error('Location is required in URL');
+        error.status = 400;
+        throw error;
+    }
 
-    try {
-        if (!location) {
-            const error = new Error('Location is required in URL');
+    const paths = {
+        pythonScript: path.join(__dirname, '../python/process_jha.py'),  // update to reflect actual purpose if needed
+        output: path.join(__dirname, '../../output'),
+        uploads: path.join(__dirname, '../../uploads'),
+        locationDocs: path.join(__dirname, '../../uploads/jha', location)
+    };
+
+    // Validate paths
+    for (const [label, dirPath] of Object.entries(paths)) {
+        if (!fs.existsSync(dirPath)) {
+            const error = new Error(`${label} path does not exist: ${dirPath}`);
             error.status = 400;
             throw error;
         }
+    }
 
-        console.log(`[${requestId}] Starting processing for location: ${location}`);
+    const validExtensions = ['.pdf', '.docx', '.xlsx', 'xlsb'];
+    const readFilesRecursively = dir => {
+    const entries = fs.readdirSync(dir, { withFileTypes: true });
+    return entries.flatMap(entry => {
+        const fullPath = path.join(dir, entry.name);
+        if (entry.isDirectory()) {
+        return readFilesRecursively(fullPath);
+        } else {
+        return fullPath;
+        }
+    });
+    };
 
-        const paths = {
-            pythonScript: path.join(__dirname, '../python/process_jha.py'),  // update to reflect actual purpose if needed
-            output: path.join(__dirname, '../../output'),
-            uploads: path.join(__dirname, '../../uploads'),
-            locationDocs: path.join(__dirname, '../../uploads/jha', location)
-        };
+    const allFiles = readFilesRecursively(paths.locationDocs);
+    const files = allFiles.filter(file =>
+    validExtensions.some(ext => file.toLowerCase().endsWith(ext))
+    );
 
-        // Validate paths
-        for (const [label, dirPath] of Object.entries(paths)) {
-            if (!fs.existsSync(dirPath)) {
-                const error = new Error(`${label} path does not exist: ${dirPath}`);
-                error.status = 400;
-                throw error;
-            }
-        }
 
-        const validExtensions = ['.pdf', '.docx', '.xlsx', 'xlsb'];
-        const readFilesRecursively = dir => {
-        const entries = fs.readdirSync(dir, { withFileTypes: true });
-        return entries.flatMap(entry => {
-            const fullPath = path.join(dir, entry.name);
-            if (entry.isDirectory()) {
-            return readFilesRecursively(fullPath);
-            } else {
-            return fullPath;
-            }
-        });
+    if (files.length === 0) {
+        const error = new Error(`No valid documents found for location ${location}`);
+        error.status = 400;
+        error.details = {
+            path: paths.locationDocs,
+            files: fs.readdirSync(paths.locationDocs)
         };
+        throw error;
+    }
 
-        const allFiles = readFilesRecursively(paths.locationDocs);
-        const files = allFiles.filter(file =>
-        validExtensions.some(ext => file.toLowerCase().endsWith(ext))
-        );
+    fs.mkdirSync(paths.output, { recursive: true });
 
+    return paths;
+};
 
-        if (files.length === 0) {
-            const error = new Error(`No valid documents found for location ${location}`);
-            error.status = 400;
-            error.details = {
-                path: paths.locationDocs,
-                files: fs.readdirSync(paths.locationDocs)
-            };
-            throw error;
-        }
+router.post('/:location', async (req, res) => {
+    const { location } = req.params;
+    const requestId = Date.now();
+
+    try {
+        console.log(`[${requestId}] Starting processing for location: ${location}`);
 
-        fs.mkdirSync(paths.output, { recursive: true });
+        const paths = validateLocation(location);
 
         const command = `python "${paths.pythonScript}" --location "${location}" --uploads_root "${paths.uploads}"`;
         console.log(`[${requestId}] Running: ${command}`);
@@ -96,13 +105,22 @@ router.post('/:location', async (req, res) => {
             console.error(`[${requestId}] Python stderr:\n${stderr}`);
         }
 
-        const resultFile = path.join(paths.output, 'jha_processed.xlsb');
+        // process_jha.py writes <output>/jha/<location>/jha_processed.xlsx
+        const resultFile = path.join(paths.output, 'jha', location, 'jha_processed.xlsx');
         if (!fs.existsSync(resultFile)) {
             const error = new Error('Expected result file was not generated');
             error.status = 500;
             throw error;
         }
 
+        // Per-stage timings and API usage written by the run
+        const metricsFile = path.join(paths.output, 'jha', location, 'jha_processed.metrics.json');
+        const metrics = readRunMetrics(metricsFile);
+        if (metrics) {
+            console.log(`[${requestId}] Run metrics:`, JSON.stringify(metrics));
+        }
+        setMetricsHeader(res, metrics);
+
         res.download(resultFile, 'jha_processed.xlsx', err => {
             if (err) {
                 logError(err, { requestId, location });
@@ -113,6 +131,7 @@ router.post('/:location', async (req, res) => {
 
             try {
                 fs.unlinkSync(resultFile);
+                if (metrics) fs.unlinkSync(metricsFile);
             } catch (cleanupError) {
                 logError(cleanupError, { requestId, location });
             }
@@ -128,4 +147,50 @@ router.post('/:location', async (req, res) => {
     }
 });
 
+// Queue processing on the Python worker and return immediately with a job id
+router.post('/:location/jobs', (req, res) => {
+    const { location } = req.params;
+    const requestId = Date.now();
+
+    try {
+        validateLocation(location);
+        const jobId = submitJob('jha', location);
+        console.log(`[${requestId}] Queued JHA job ${jobId} for location: ${location}`);
+        res.status(202).json({ jobId, status: 'queued', statusUrl: `${req.baseUrl}/jobs/${jobId}` });
+    } catch (error) {
+        logError(error, { requestId, location });
+        res.status(error.status || 500).json({
+            error: error.message,
+            requestId,
+            details: error.details
+        });
+    }
+});
+
+// Poll a queued job
+router.get('/jobs/:jobId', (req, res) => {
+    const job = getJobStatus(req.params.jobId);
+    if (!job) return res.status(404).json({ error: 'Job not found' });
+    const { result, ...status } = job;
+    res.json(status);
+});
+
+// Download a finished job's workbook
+router.get('/jobs/:jobId/result', (req, res) => {
+    const job = getJobStatus(req.params.jobId);
+    if (!job) return res.status(404).json({ error: 'Job not found' });
+    if (job.status !== 'done') {
+        return res.status(409).json({ error: `Job is ${job.status}`, status: job.status });
+    }
+    setMetricsHeader(res, job.metrics);
+    res.download(job.result, 'jha_processed.xlsx', err => {
+        if (err) {
+            logError(err, { jobId: job.jobId });
+            if (!res.headersSent) {
+                res.status(500).json({ error: 'Download failed', jobId: job.jobId });
+            }
+        }
+    });
+});
+
 module.exports = router;
@@ -4,6 +4,8 @@ const path = require('path');
 const router = express.Router();
 const { exec } = require('child_process');
 const util = require('util');
+const { submitJob, getJobStatus } = require('../jobQueue');
+const { readRunMetrics, setMetricsHeader } = require('../runMetrics');
 
 // Convert exec to promise-based for better error handling
 const execPromise = util.promisify(require('child_process').exec);
@@ -26,73 +28,80 @@ const logError = (error, context = {}) => {
     fs.appendFileSync('server_errors.log', JSON.stringify(logEntry) + '\n');
 };
 
-router.post('/', async (req, res) => {
-    const { locationNumber } = req.body;
-    const requestId = Date.now(); // Unique ID for this request
-    
-    try {
-        // Validate input
-        if (!locationNumber) {
-            const error = new Error('Location number is required');
+// Validate a location's uploads and return its paths
+const validateLocation = (locationNumber, requestId) => {
+    // Validate input
+    if (!locationNumber) {
+        const error = new Error('Location number is required');
+        error.status = 400;
+        throw error;
+    }
+
+    // Path configuration with validation
+    const paths = {
+        pythonScript: path.join(__dirname, '../python/process_equipment.py'),
+        output: path.join(__dirname, '../../output'),
+        uploads: path.join(__dirname, '../../uploads'),
+        photos: path.join(__dirname, '../../uploads/photos', locationNumber),
+        manufacturer: path.join(__dirname, '../../uploads/manufacturer', locationNumber)
+    };
+
+    // Verify all paths exist
+    for (const [name, path] of Object.entries(paths)) {
+        if (!fs.existsSync(path)) {
+            const error = new Error(`${name} path does not exist: ${path}`);
             error.status = 400;
             throw error;
         }
+    }
 
-        console.log(`[${requestId}] Processing request for location: ${locationNumber}`);
+    // Check for photos
+    const photoFiles = fs.readdirSync(paths.photos).filter(f => 
+        ['.jpg', '.jpeg', '.png'].some(ext => f.toLowerCase().endsWith(ext))
+    );
+    
+    if (photoFiles.length === 0) {
+        const error = new Error(`No valid photos found for location ${locationNumber}`);
+        error.status = 400;
+        error.details = {
+            path: paths.photos,
+            files: fs.readdirSync(paths.photos)
+        };
+        throw error;
+    }
 
-        // Path configuration with validation
-        const paths = {
-            pythonScript: path.join(__dirname, '../python/process_equipment.py'),
-            output: path.join(__dirname, '../../output'),
-            uploads: path.join(__dirname, '../../uploads'),
-            photos: path.join(__dirname, '../../uploads/photos', locationNumber),
-            manufacturer: path.join(__dirname, '../../uploads/manufacturer', locationNumber)
+    // Check for manufacturer file
+    const manufacturerFiles = fs.readdirSync(paths.manufacturer).filter(f => 
+        ['.xlsx', '.xls'].some(ext => f.toLowerCase().endsWith(ext))
+    );
+    
+    if (manufacturerFiles.length === 0) {
+        const error = new Error(`No manufacturer file found for location ${locationNumber}`);
+        error.status = 400;
+        error.details = {
+            path: paths.manufacturer,
+            files: fs.readdirSync(paths.manufacturer)
         };
+        throw error;
+    }
 
-        // Verify all paths exist
-        for (const [name, path] of Object.entries(paths)) {
-            if (!fs.existsSync(path)) {
-                const error = new Error(`${name} path does not exist: ${path}`);
-                error.status = 400;
-                throw error;
-            }
-        }
+    // Ensure output directory exists
+    fs.mkdirSync(paths.output, { recursive: true });
 
-        // Check for photos
-        const photoFiles = fs.readdirSync(paths.photos).filter(f => 
-            ['.jpg', '.jpeg', '.png'].some(ext => f.toLowerCase().endsWith(ext))
-        );
-        
-        if (photoFiles.length === 0) {
-            const error = new Error(`No valid photos found for location ${locationNumber}`);
-            error.status = 400;
-            error.details = {
-                path: paths.photos,
-                files: fs.readdirSync(paths.photos)
-            };
-            throw error;
-        }
+    console.log(`[${requestId}] Paths verified successfully`);
+    console.log(`[${requestId}] Found ${photoFiles.length} photos and ${manufacturerFiles.length} manufacturer files`);
 
-        // Check for manufacturer file
-        const manufacturerFiles = fs.readdirSync(paths.manufacturer).filter(f => 
-            ['.xlsx', '.xls'].some(ext => f.toLowerCase().endsWith(ext))
-        );
-        
-        if (manufacturerFiles.length === 0) {
-            const error = new Error(`No manufacturer file found for location ${locationNumber}`);
-            error.status = 400;
-            error.details = {
-                path: paths.manufacturer,
-                files: fs.readdirSync(paths.manufacturer)
-            };
-            throw error;
-        }
+    return paths;
+};
 
-        // Ensure output directory exists
-        fs.mkdirSync(paths.output, { recursive: true });
+router.post('/', async (req, res) => {
+    const { locationNumber } = req.body;
+    const requestId = Date.now(); // Unique ID for this request
+    
+    try {
+        console.log(`[${requestId}] Processing request for location: ${locationNumber}`);
 
-        console.log(`[${requestId}] Paths verified successfully`);
-        console.log(`[${requestId}] Found ${photoFiles.length} photos and ${manufacturerFiles.length} manufacturer files`);
+        const paths = validateLocation(locationNumber, requestId);
 
         // Build command with error handling
         const command = `python "${paths.pythonScript}" --location "${locationNumber}" --output "${paths.output}" --uploads_root "${paths.uploads}"`;
@@ -131,6 +140,14 @@ router.post('/', async (req, res) => {
             throw error;
         }
 
+        // Per-stage timings, API usage and match counts written by the run
+        const metricsFile = path.join(paths.output, 'equipment_inventory.metrics.json');
+        const metrics = readRunMetrics(metricsFile);
+        if (metrics) {
+            console.log(`[${requestId}] Run metrics:`, JSON.stringify(metrics));
+        }
+        setMetricsHeader(res, metrics);
+
         // Stream the file with proper cleanup
         const downloadName = `equipment_report_${locationNumber}.csv`;
         res.download(resultFile, downloadName, (err) => {
@@ -147,6 +164,7 @@ router.post('/', async (req, res) => {
             // Cleanup
             try {
                 fs.unlinkSync(resultFile);
+                if (metrics) fs.unlinkSync(metricsFile);
             } catch (cleanupError) {
                 logError(cleanupError, { requestId, locationNumber });
             }
@@ -171,4 +189,50 @@ router.post('/', async (req, res) => {
     }
 });
 
+// Queue processing on the Python worker and return immediately with a job id
+router.post('/jobs', (req, res) => {
+    const { locationNumber } = req.body;
+    const requestId = Date.now();
+
+    try {
+        validateLocation(locationNumber, requestId);
+        const jobId = submitJob('equipment', locationNumber);
+        console.log(`[${requestId}] Queued equipment job ${jobId} for location: ${locationNumber}`);
+        res.status(202).json({ jobId, status: 'queued', statusUrl: `${req.baseUrl}/jobs/${jobId}` });
+    } catch (error) {
+        logError(error, { requestId, locationNumber });
+        res.status(error.status || 500).json({
+            error: error.message,
+            requestId,
+            details: error.details || undefined
+        });
+    }
+});
+
+// Poll a queued job
+router.get('/jobs/:jobId', (req, res) => {
+    const job = getJobStatus(req.params.jobId);
+    if (!job) return res.status(404).json({ error: 'Job not found' });
+    const { result, ...status } = job;
+    res.json(status);
+});
+
+// Download a finished job's inventory
+router.get('/jobs/:jobId/result', (req, res) => {
+    const job = getJobStatus(req.params.jobId);
+    if (!job) return res.status(404).json({ error: 'Job not found' });
+    if (job.status !== 'done') {
+        return res.status(409).json({ error: `Job is ${job.status}`, status: job.status });
+    }
+    setMetricsHeader(res, job.metrics);
+    res.download(job.result, `equipment_report_${job.jobId}.csv`, err => {
+        if (err) {
+            logError(err, { jobId: job.jobId });
+            if (!res.headersSent) {
+                res.status(500).json({ error: 'File download failed', jobId: job.jobId });
+            }
+        }
+    });
+});
+
 module.exports = router;
\ No newline at end of file
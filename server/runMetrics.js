@@ -0,0 +1,23 @@
+const fs = require('fs');
+
+// Response header carrying a run's metrics summary next to the downloaded file
+const METRICS_HEADER = 'X-Processing-Metrics';
+
+// Metrics summary written by a Python run (run_metrics.py), or null if there is none
+const readRunMetrics = metricsFile => {
+    try {
+        return JSON.parse(fs.readFileSync(metricsFile, 'utf8'));
+    } catch (error) {
+        return null;
+    }
+};
+
+// Attach a metrics summary to a response as compact JSON
+const setMetricsHeader = (res, metrics) => {
+    if (!metrics) return;
+    // Header values must be ASCII; escaping keeps the JSON valid
+    const value = JSON.stringify(metrics).replace(/[^\x20-\x7e]/g, c => `\\u${c.charCodeAt(0).toString(16).padStart(4, '0')}`);
+    res.set(METRICS_HEADER, value);
+};
+
+module.exports = { METRICS_HEADER, readRunMetrics, setMetricsHeader };